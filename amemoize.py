@@ -0,0 +1,108 @@
+# This file is part of stupid_python_tricks written by Duncan Townsend.
+#
+# stupid_python_tricks is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# stupid_python_tricks is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with stupid_python_tricks.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import warnings
+from collections import MutableMapping
+
+import trollius as asyncio
+from trollius import From, Return
+
+from decorator_decorator import decorator_decorator
+from memoize import make_cache, format_memo_args, CacheInfo, \
+     _cache_maxsize, _missing, _unhashable
+
+@decorator_decorator
+def amemoize(f=None, cache=None, maxsize=None, policy="lru", ttl=None):
+    """amemoize memoizes a coroutine function. It takes the same arguments
+    as memoize, e.g.
+
+    @amemoize(maxsize=1024)
+    @asyncio.coroutine
+    def foo(*args, **kwargs):
+        ...
+
+    The memoized function is a coroutine function too. Concurrent calls with
+    equal arguments share a single call to the original function. If that
+    call raises, every waiter gets the exception and nothing is cached. A
+    waiter that is cancelled doesn't cancel the call for the others.
+
+    Unlike memoize, amemoize doesn't take any locks: it's meant to be used
+    from a single event loop."""
+    if isinstance(f, MutableMapping):
+        assert cache is None
+        @decorator_decorator
+        def amemoize_with_cache(new_f):
+            return amemoize(new_f, cache=f)
+        return amemoize_with_cache
+
+    if f is None:
+        @decorator_decorator
+        def amemoize_with_options(new_f):
+            return amemoize(new_f, cache, maxsize, policy, ttl)
+        return amemoize_with_options
+
+    if cache is None:
+        cache = make_cache(maxsize, policy, ttl)
+    inflight = {}
+    # hits, misses
+    counts = [0, 0]
+
+    @asyncio.coroutine
+    def load(key, args, kwargs):
+        try:
+            retval = yield From(f(*args, **kwargs))
+            cache[key] = retval
+        finally:
+            del inflight[key]
+        raise Return(retval)
+
+    @asyncio.coroutine
+    def amemoized(*args, **kwargs):
+        try:
+            key = format_memo_args(*args, **kwargs)
+            retval = cache.get(key, _missing)
+        except TypeError as e:
+            if not _unhashable(e):
+                raise
+            warnings.warn("Unable to memoize: unhashable argument")
+            retval = yield From(f(*args, **kwargs))
+            raise Return(retval)
+        if retval is not _missing:
+            counts[0] += 1
+            raise Return(retval)
+        counts[1] += 1
+        future = inflight.get(key)
+        if future is None:
+            future = inflight[key] = asyncio.ensure_future(
+                load(key, args, kwargs))
+        retval = yield From(asyncio.shield(future))
+        raise Return(retval)
+
+    def cache_info():
+        return CacheInfo(counts[0], counts[1], _cache_maxsize(cache),
+                         len(cache))
+    def clear():
+        cache.clear()
+        counts[:] = [0, 0]
+    amemoized.cache_info = cache_info
+    amemoized.clear = clear
+    return amemoized
+
+amemoized = amemoize
+__all__ = ['amemoize', 'amemoized']
+
+import callable_module
+callable_module(amemoize)
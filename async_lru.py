@@ -0,0 +1,81 @@
+# This file is part of stupid_python_tricks written by Duncan Townsend.
+#
+# stupid_python_tricks is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# stupid_python_tricks is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with stupid_python_tricks.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import trollius as asyncio
+from trollius import From, Return
+
+from lru import LRUDict
+
+
+class NullLock(object):
+    """A lock that never blocks, for objects that are only ever touched from
+    one thread."""
+    __slots__ = []
+    def acquire(self, blocking=True):
+        return True
+
+    def release(self):
+        pass
+
+    def __enter__(self):
+        return True
+
+    def __exit__(self, e, t, b):
+        pass
+
+
+class AsyncLRUDict(LRUDict):
+    """A LRUDict for use from a single asyncio event loop. Since only the
+    event loop's thread touches it, it uses a NullLock instead of a RLock,
+    so the loop never blocks.
+
+    get_or_load(key, coro_fn) returns the cached value for key, or else
+    calls coro_fn() and waits for the coroutine it returns. Concurrent misses
+    for the same key share a single call to coro_fn. If the coroutine
+    raises, every waiter gets the exception and nothing is cached. A waiter
+    that is cancelled doesn't cancel the load for the others."""
+    __slots__ = LRUDict.__slots__ + ["inflight"]
+    def __init__(self, maxsize=1024, *args, **kwargs):
+        self.inflight = {}
+        super(AsyncLRUDict, self).__init__(maxsize, *args, **kwargs)
+        self.lock = NullLock()
+
+    @asyncio.coroutine
+    def get_or_load(self, key, coro_fn):
+        try:
+            value = self[key]
+        except KeyError:
+            pass
+        else:
+            raise Return(value)
+        inflight = self.inflight
+        future = inflight.get(key)
+        if future is None:
+            future = inflight[key] = asyncio.ensure_future(self._load(key, coro_fn))
+        value = yield From(asyncio.shield(future))
+        raise Return(value)
+
+    @asyncio.coroutine
+    def _load(self, key, coro_fn):
+        try:
+            value = yield From(coro_fn())
+            self[key] = value
+        finally:
+            del self.inflight[key]
+        raise Return(value)
+
+
+__all__ = ["NullLock", "AsyncLRUDict"]
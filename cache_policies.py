@@ -0,0 +1,473 @@
+# This file is part of stupid_python_tricks written by Duncan Townsend.
+#
+# stupid_python_tricks is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# stupid_python_tricks is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with stupid_python_tricks.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from collections import MutableMapping, OrderedDict
+from threading import RLock
+from itertools import imap, chain
+from copy import deepcopy
+from array import array
+
+from lru import LRUDict
+
+
+# All of the policies below keep their queues in OrderedDicts, oldest entry
+# first. Python 2's OrderedDict has no move_to_end, so a "touch" is a pop
+# followed by a reinsert.
+
+class PolicyDict(MutableMapping):
+    """Base class for the scan-resistant caches in this module. Subclasses
+    supply _lookup, _store, _remove, _shrink and _iterkeys; this class
+    supplies the locking, the hits/misses counters, and the rest of the
+    LRUDict interface."""
+    __slots__ = ["maxsize", "hits", "misses", "lock"]
+    def __init__(self, maxsize=1024, *args, **kwargs):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.lock = RLock()
+        self._reset()
+        self.update(*args, **kwargs)
+
+    def __getitem__(self, key):
+        with self.lock:
+            try:
+                value = self._lookup(key)
+                self.hits += 1
+                return value
+            except KeyError:
+                self.misses += 1
+                raise
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self._store(key, value)
+
+    def __delitem__(self, key):
+        with self.lock:
+            self._remove(key)
+
+    def resize(self, newsize):
+        with self.lock:
+            self.maxsize = newsize
+            self._shrink()
+
+    def __iter__(self):
+        # lookups reorder the queues, so iterate over a snapshot
+        with self.lock:
+            return iter(list(self._iterkeys()))
+
+    def __repr__(self):
+        return "%s.%s(%s)" % (type(self).__module__,
+                              type(self).__name__,
+                              repr(dict(self.iteritems())))
+
+    def __copy__(self):
+        return type(self)(self.maxsize, self.iteritems())
+
+    def __deepcopy__(self, memo):
+        return type(self)(self.maxsize,
+                          imap(lambda (k,v): (deepcopy(k, memo), deepcopy(v, memo)),
+                               self.iteritems()))
+
+
+class TwoQueueDict(PolicyDict):
+    """The full 2Q policy of Johnson and Shasha. New keys enter a small FIFO
+    (a1in). Keys that fall out of a1in are remembered, without their values,
+    in a ghost FIFO (a1out). Only a key that is requested again while it is
+    remembered in a1out is admitted to the main LRU queue (am). A one-off
+    scan therefore passes through a1in without disturbing am."""
+    __slots__ = PolicyDict.__slots__ + ["a1in", "a1out", "am", "kin", "kout"]
+    def _reset(self):
+        self.a1in = OrderedDict()
+        self.a1out = OrderedDict()
+        self.am = OrderedDict()
+        self._set_limits()
+
+    def _set_limits(self):
+        self.kin = max(self.maxsize // 4, 1)
+        self.kout = max(self.maxsize // 2, 1)
+
+    def _lookup(self, key):
+        am = self.am
+        if key in am:
+            value = am[key] = am.pop(key)
+            return value
+        # hits in a1in deliberately don't count as recent use
+        return self.a1in[key]
+
+    def _reclaim(self):
+        a1in = self.a1in
+        am = self.am
+        if len(a1in) + len(am) < self.maxsize:
+            return
+        if len(a1in) > self.kin or not am:
+            key, _ = a1in.popitem(last=False)
+            a1out = self.a1out
+            a1out[key] = None
+            while len(a1out) > self.kout:
+                a1out.popitem(last=False)
+        else:
+            am.popitem(last=False)
+
+    def _store(self, key, value):
+        if self.maxsize <= 0:
+            return
+        am = self.am
+        a1in = self.a1in
+        a1out = self.a1out
+        if key in am:
+            del am[key]
+            am[key] = value
+        elif key in a1in:
+            a1in[key] = value
+        elif key in a1out:
+            del a1out[key]
+            self._reclaim()
+            am[key] = value
+        else:
+            self._reclaim()
+            a1in[key] = value
+
+    def _remove(self, key):
+        if key in self.am:
+            del self.am[key]
+        else:
+            del self.a1in[key]
+        self.a1out.pop(key, None)
+
+    def _shrink(self):
+        self._set_limits()
+        while len(self) > max(self.maxsize, 0):
+            self._reclaim()
+        a1out = self.a1out
+        while len(a1out) > self.kout:
+            a1out.popitem(last=False)
+
+    def _iterkeys(self):
+        return chain(self.a1in.iterkeys(), self.am.iterkeys())
+
+    def __len__(self):
+        return len(self.a1in) + len(self.am)
+
+
+class ARCDict(PolicyDict):
+    """The Adaptive Replacement Cache of Megiddo and Modha. t1 holds keys seen
+    once recently, t2 keys seen at least twice; b1 and b2 are ghost lists of
+    keys recently evicted from each. Hits in the ghost lists move the target
+    size p of t1 towards whichever list would have avoided the miss, so the
+    cache adapts between recency and frequency on its own."""
+    __slots__ = PolicyDict.__slots__ + ["t1", "t2", "b1", "b2", "p"]
+    def _reset(self):
+        self.t1 = OrderedDict()
+        self.t2 = OrderedDict()
+        self.b1 = OrderedDict()
+        self.b2 = OrderedDict()
+        self.p = 0
+
+    def _lookup(self, key):
+        t1 = self.t1
+        t2 = self.t2
+        if key in t1:
+            value = t2[key] = t1.pop(key)
+        else:
+            value = t2[key] = t2.pop(key)
+        return value
+
+    def _replace(self, in_b2):
+        t1 = self.t1
+        if t1 and (len(t1) > self.p or (in_b2 and len(t1) == self.p)):
+            key, _ = t1.popitem(last=False)
+            self.b1[key] = None
+        else:
+            key, _ = self.t2.popitem(last=False)
+            self.b2[key] = None
+
+    def _full(self):
+        return len(self.t1) + len(self.t2) >= self.maxsize
+
+    def _store(self, key, value):
+        c = self.maxsize
+        if c <= 0:
+            return
+        t1 = self.t1
+        t2 = self.t2
+        b1 = self.b1
+        b2 = self.b2
+        if key in t1:
+            del t1[key]
+            t2[key] = value
+        elif key in t2:
+            del t2[key]
+            t2[key] = value
+        elif key in b1:
+            self.p = min(c, self.p + max(len(b2) // len(b1), 1))
+            del b1[key]
+            if self._full():
+                self._replace(False)
+            t2[key] = value
+        elif key in b2:
+            self.p = max(0, self.p - max(len(b1) // len(b2), 1))
+            del b2[key]
+            if self._full():
+                self._replace(True)
+            t2[key] = value
+        else:
+            l1 = len(t1) + len(b1)
+            if l1 >= c:
+                if len(t1) < c:
+                    b1.popitem(last=False)
+                    if self._full():
+                        self._replace(False)
+                else:
+                    t1.popitem(last=False)
+            else:
+                total = l1 + len(t2) + len(b2)
+                if total >= c:
+                    if total >= 2 * c and b2:
+                        b2.popitem(last=False)
+                    if self._full():
+                        self._replace(False)
+            t1[key] = value
+
+    def _remove(self, key):
+        if key in self.t1:
+            del self.t1[key]
+        else:
+            del self.t2[key]
+
+    def _shrink(self):
+        c = max(self.maxsize, 0)
+        self.p = min(self.p, c)
+        while len(self.t1) + len(self.t2) > c:
+            self._replace(False)
+        t1 = self.t1
+        b1 = self.b1
+        b2 = self.b2
+        while b1 and len(t1) + len(b1) > c:
+            b1.popitem(last=False)
+        while b2 and len(self) + len(b1) + len(b2) > 2 * c:
+            b2.popitem(last=False)
+
+    def _iterkeys(self):
+        return chain(self.t1.iterkeys(), self.t2.iterkeys())
+
+    def __len__(self):
+        return len(self.t1) + len(self.t2)
+
+
+class CountMinSketch(object):
+    """An approximate frequency counter for TinyLFU. Counters are 4 bits
+    wide (stored one per byte) and are all halved once the number of
+    increments reaches sample_size, so old popularity fades away."""
+    __slots__ = ["depth", "mask", "table", "sample_size", "additions"]
+    def __init__(self, width, sample_size, depth=4):
+        size = 1
+        while size < width:
+            size <<= 1
+        self.depth = depth
+        self.mask = size - 1
+        self.table = array('B', [0]) * (size * depth)
+        self.sample_size = sample_size
+        self.additions = 0
+
+    def _indexes(self, key):
+        h = (hash(key) * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        h1 = h & 0xFFFFFFFF
+        h2 = (h >> 32) | 1
+        mask = self.mask
+        width = mask + 1
+        return [ row * width + ((h1 + row * h2) & mask)
+                 for row in xrange(self.depth) ]
+
+    def increment(self, key):
+        table = self.table
+        for i in self._indexes(key):
+            if table[i] < 15:
+                table[i] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self.table = array('B', (c >> 1 for c in table))
+            self.additions //= 2
+
+    def estimate(self, key):
+        table = self.table
+        return min(table[i] for i in self._indexes(key))
+
+
+class TinyLFUDict(PolicyDict):
+    """The W-TinyLFU policy used by Caffeine. New keys enter a small LRU
+    window. Keys that fall out of the window are only admitted to the main
+    segmented LRU (probation and protected queues) if a CountMinSketch says
+    they have been requested more often than the entry they would evict.
+    The window absorbs short bursts and the frequency filter keeps scans
+    from displacing popular keys."""
+    __slots__ = PolicyDict.__slots__ + ["window", "probation", "protected",
+                                        "window_size", "protected_size",
+                                        "sketch"]
+    def _reset(self):
+        self.window = OrderedDict()
+        self.probation = OrderedDict()
+        self.protected = OrderedDict()
+        self.sketch = None
+        self._set_limits()
+
+    def _set_limits(self):
+        maxsize = max(self.maxsize, 0)
+        self.window_size = max(maxsize // 100, 1)
+        self.protected_size = max(maxsize - self.window_size, 0) * 4 // 5
+        sketch = self.sketch
+        if sketch is None or sketch.mask + 1 < maxsize:
+            self.sketch = CountMinSketch(maxsize, 10 * max(maxsize, 1))
+
+    def _lookup(self, key):
+        self.sketch.increment(key)
+        window = self.window
+        protected = self.protected
+        if key in window:
+            value = window[key] = window.pop(key)
+        elif key in protected:
+            value = protected[key] = protected.pop(key)
+        else:
+            value = self.probation.pop(key)
+            protected[key] = value
+            self._demote()
+        return value
+
+    def _demote(self):
+        protected = self.protected
+        while len(protected) > self.protected_size:
+            key, value = protected.popitem(last=False)
+            self.probation[key] = value
+
+    def _victim_queue(self):
+        if self.probation:
+            return self.probation
+        return self.protected
+
+    def _admit(self, key, value):
+        # key has just fallen out of the window
+        probation = self.probation
+        if len(probation) + len(self.protected) < self.maxsize - self.window_size:
+            probation[key] = value
+            return
+        queue = self._victim_queue()
+        if not queue:
+            return
+        victim = next(queue.iterkeys())
+        sketch = self.sketch
+        if sketch.estimate(key) > sketch.estimate(victim):
+            del queue[victim]
+            probation[key] = value
+
+    def _store(self, key, value):
+        if self.maxsize <= 0:
+            return
+        for queue in (self.window, self.probation, self.protected):
+            if key in queue:
+                queue[key] = value
+                return
+        self.sketch.increment(key)
+        window = self.window
+        window[key] = value
+        while len(window) > self.window_size:
+            self._admit(*window.popitem(last=False))
+
+    def _remove(self, key):
+        for queue in (self.window, self.probation, self.protected):
+            if key in queue:
+                del queue[key]
+                return
+        raise KeyError(key)
+
+    def _shrink(self):
+        self._set_limits()
+        maxsize = max(self.maxsize, 0)
+        window = self.window
+        probation = self.probation
+        while len(window) > self.window_size:
+            key, value = window.popitem(last=False)
+            probation[key] = value
+        # leave the window room to fill up again, or the main segment takes
+        # us over maxsize as soon as it does
+        main_size = max(maxsize - self.window_size, 0)
+        while len(probation) + len(self.protected) > main_size:
+            self._victim_queue().popitem(last=False)
+        while len(window) > maxsize:
+            window.popitem(last=False)
+        self._demote()
+
+    def _iterkeys(self):
+        return chain(self.window.iterkeys(), self.probation.iterkeys(),
+                     self.protected.iterkeys())
+
+    def __len__(self):
+        return len(self.window) + len(self.probation) + len(self.protected)
+
+
+def replay(cache, trace):
+    """Run the keys in trace through cache the way memoize would, filling
+    every miss. Returns the hit ratio."""
+    hits = 0
+    requests = 0
+    for key in trace:
+        requests += 1
+        try:
+            cache[key]
+            hits += 1
+        except KeyError:
+            cache[key] = key
+    return float(hits) / max(requests, 1)
+
+
+def scan_trace(length=100000, hot_keys=2000, scan_every=20000,
+               scan_length=10000, seed=0):
+    """A trace of skewed requests over hot_keys keys, interrupted every
+    scan_every requests by a scan over scan_length keys that are never
+    requested again."""
+    from random import Random
+    rng = Random(seed)
+    next_cold = [hot_keys]
+    def scan():
+        start = next_cold[0]
+        next_cold[0] += scan_length
+        return xrange(start, start + scan_length)
+    i = 0
+    while i < length:
+        if i and i % scan_every == 0:
+            for key in scan():
+                yield key
+        yield int(hot_keys * rng.random() ** 3)
+        i += 1
+
+
+def compare_hit_ratios(trace, maxsize=1000,
+                       policies=(LRUDict, TwoQueueDict, ARCDict, TinyLFUDict)):
+    """Replay trace through each policy with the given maxsize. Returns a list
+    of (policy name, hit ratio) pairs."""
+    trace = list(trace)
+    return [ (policy.__name__, replay(policy(maxsize), trace))
+             for policy in policies ]
+
+
+__all__ = ["TwoQueueDict", "ARCDict", "TinyLFUDict", "CountMinSketch",
+           "replay", "scan_trace", "compare_hit_ratios"]
+
+
+if __name__ == '__main__':
+    import sys
+    maxsize = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    for name, ratio in compare_hit_ratios(scan_trace(), maxsize):
+        print "%-14s %.4f" % (name, ratio)
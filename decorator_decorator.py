@@ -22,10 +22,15 @@ def decorator_apply(dec, func, args, kwargs):
     Decorate a function by preserving the signature even if dec
     is not a signature-preserving decorator.
     """
-    return decorator.FunctionMaker.create(
+    decorated = dec(func, *args, **kwargs)
+    result = decorator.FunctionMaker.create(
         func, 'return decorated(%(signature)s)',
-        dict(decorated=dec(func, *args, **kwargs)), __wrapped__=func,
+        dict(decorated=decorated), __wrapped__=func,
         addsource=True)
+    # expose any attributes that dec hung on its wrapper (e.g. memoize's clear)
+    for name, value in getattr(decorated, '__dict__', {}).iteritems():
+        result.__dict__.setdefault(name, value)
+    return result
 
 @decorator.decorator
 def decorator_decorator(dec, func, *args, **kwargs):
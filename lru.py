@@ -14,15 +14,68 @@
 # with stupid_python_tricks.  If not, see <http://www.gnu.org/licenses/>.
 
 
-from collections import MutableMapping
-from threading import RLock
-from itertools import imap
-from weakref import ref
+from collections import Mapping, MutableMapping, deque, namedtuple
+from threading import RLock, local, Thread
+from time import time, sleep
+from itertools import imap, izip, islice, chain, repeat
+from weakref import ref, WeakValueDictionary
 from copy import deepcopy
+from array import array
+import sys
+import os
+import cPickle
+import gc
+from mmap import mmap, ACCESS_READ
+from tempfile import NamedTemporaryFile
+
+
+class TimedRLock(object):
+    """A RLock that keeps a running total of how long its callers have spent
+    waiting to acquire it. Uncontended acquisitions aren't timed."""
+    __slots__ = ["_lock", "wait_time"]
+    clock = staticmethod(time)
+    def __init__(self):
+        self._lock = RLock()
+        self.wait_time = 0.0
+
+    def acquire(self, blocking=True):
+        lock = self._lock
+        if lock.acquire(False):
+            return True
+        if not blocking:
+            return False
+        start = self.clock()
+        lock.acquire()
+        # we hold the lock, so this is safe
+        self.wait_time += self.clock() - start
+        return True
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, e, t, b):
+        self.release()
+
+
+LRUStats = namedtuple("LRUStats", ["hits", "misses", "evictions", "insertions",
+                                   "updates", "size", "peak_size", "maxsize",
+                                   "lock_wait", "window_hit_ratio"])
+
 
 class LRUDict(MutableMapping):
-    """Adapted from ActiveState recipe 578078"""
-    __slots__ = ["sentinel", "root", "maxsize", "hits", "misses", "lock", "cache"]
+    """Adapted from ActiveState recipe 578078
+
+    Besides hits and misses, LRUDict counts evictions, insertions and
+    updates, and remembers its peak size; stats() gives a snapshot of all
+    of them. If on_evict is set, it is called as on_evict(key, value,
+    reason) (with the lock held) whenever an entry is evicted rather than
+    deleted. instrument() turns on the more expensive statistics."""
+    __slots__ = ["sentinel", "root", "maxsize", "hits", "misses", "lock", "cache",
+                 "evictions", "insertions", "updates", "peak_size", "window",
+                 "on_evict"]
     def __init__(self, maxsize=1024, *args, **kwargs):
         sentinel = object()
         self.sentinel = sentinel
@@ -34,8 +87,45 @@ class LRUDict(MutableMapping):
         self.misses = 0
         self.lock = RLock()
         self.cache = {}
+        self.evictions = 0
+        self.insertions = 0
+        self.updates = 0
+        self.peak_size = 0
+        self.window = None
+        self.on_evict = None
         self.update(*args, **kwargs)
 
+    def instrument(self, window=1024, time_lock=True):
+        """Keep a hit ratio over the last window lookups and, if time_lock is
+        true, time how long callers wait for the lock. Call this before the
+        dict is shared between threads."""
+        with self.lock:
+            self.window = deque(maxlen=window) if window else None
+            if time_lock and not isinstance(self.lock, TimedRLock):
+                self.lock = TimedRLock()
+
+    def stats(self):
+        """Returns a LRUStats snapshot of this dict's statistics. lock_wait and
+        window_hit_ratio are None unless they have been turned on by
+        instrument()."""
+        with self.lock:
+            window = self.window
+            if window:
+                window_hit_ratio = float(sum(window)) / len(window)
+            else:
+                window_hit_ratio = None
+            return LRUStats(self.hits, self.misses, self.evictions,
+                            self.insertions, self.updates, len(self),
+                            self.peak_size, self.maxsize,
+                            getattr(self.lock, "wait_time", None),
+                            window_hit_ratio)
+
+    def _evicted(self, key, value, reason):
+        self.evictions += 1
+        on_evict = self.on_evict
+        if on_evict is not None:
+            on_evict(key, value, reason)
+
     def _make_link(self, key, value):
         sentinel = self.sentinel
         return [ sentinel, sentinel, key, value ]
@@ -43,7 +133,8 @@ class LRUDict(MutableMapping):
     def _mark_recent_use(self, link):
         with self.lock:
             root = self.root
-            link_prev, link_next, key, result = link
+            link_prev = link[0]
+            link_next = link[1]
             link_prev[1] = link_next
             link_next[0] = link_prev
             last = root[0]
@@ -57,20 +148,27 @@ class LRUDict(MutableMapping):
                 link = self.cache[key]
                 self._mark_recent_use(link)
                 self.hits += 1
+                if self.window is not None:
+                    self.window.append(True)
                 return link[3]
             except KeyError:
                 self.misses += 1
+                if self.window is not None:
+                    self.window.append(False)
                 raise
 
     def _add_new(self, link):
         with self.lock:
-            self.cache[link[2]] = link
+            cache = self.cache
+            cache[link[2]] = link
             root = self.root
             last = root[0]
             last[1] = link
             link[1] = root
             link[0] = last
             root[0] = link
+            if len(cache) > self.peak_size:
+                self.peak_size = len(cache)
 
     def replace_oldest(self, key, value):
         with self.lock:
@@ -80,16 +178,20 @@ class LRUDict(MutableMapping):
             oldroot[2] = key
             oldroot[3] = value
             self.root = newroot = oldroot[1]
-            del cache[newroot[2]]
+            old_key = newroot[2]
+            old_value = newroot[3]
+            del cache[old_key]
             sentinel = self.sentinel
             newroot[2] = sentinel
             newroot[3] = sentinel
+            self._evicted(old_key, old_value, "size")
 
     def __setitem__(self, key, value):
         with self.lock:
             sentinel = self.sentinel
             link = self.cache.get(key, sentinel)
             if link is sentinel:
+                self.insertions += 1
                 maxsize = self.maxsize
                 length = len(self.cache)
                 if length == maxsize:
@@ -100,6 +202,7 @@ class LRUDict(MutableMapping):
                 else:
                     raise RuntimeError("LRUDict size exceeds maximum size")
             else:
+                self.updates += 1
                 link[3] = value
                 self._mark_recent_use(link)
 
@@ -117,7 +220,7 @@ class LRUDict(MutableMapping):
             self._remove_link(link)
             del cache[key]
 
-    def remove_oldest(self):
+    def remove_oldest(self, reason="size"):
         with self.lock:
             oldroot = self.root
             newroot = oldroot[1]
@@ -125,10 +228,107 @@ class LRUDict(MutableMapping):
             newroot[0] = last
             last[1] = newroot
             self.root = newroot
-            del self.cache[newroot[2]]
+            old_key = newroot[2]
+            old_value = newroot[3]
+            del self.cache[old_key]
             sentinel = self.sentinel
             newroot[2] = sentinel
             newroot[3] = sentinel
+            self._evicted(old_key, old_value, reason)
+
+    def get_many(self, keys):
+        """Look up several keys, taking the lock and relinking the list once
+        for the whole batch. Returns a dict of the keys that were found and a
+        list of the keys that were not."""
+        found = {}
+        missing = []
+        with self.lock:
+            cache = self.cache
+            root = self.root
+            hits = 0
+            for key in keys:
+                link = cache.get(key)
+                if link is None:
+                    missing.append(key)
+                    continue
+                link_prev = link[0]
+                link_next = link[1]
+                link_prev[1] = link_next
+                link_next[0] = link_prev
+                last = root[0]
+                last[1] = root[0] = link
+                link[0] = last
+                link[1] = root
+                found[key] = link[3]
+                hits += 1
+            self.hits += hits
+            self.misses += len(missing)
+            window = self.window
+            if window is not None:
+                window.extend(repeat(True, hits))
+                window.extend(repeat(False, len(missing)))
+        return found, missing
+
+    def set_many(self, items):
+        """Store a mapping or an iterable of (key, value) pairs, taking the
+        lock once and building and linking the entries in one pass."""
+        if isinstance(items, Mapping):
+            items = items.iteritems()
+        with self.lock:
+            cache = self.cache
+            root = self.root
+            sentinel = self.sentinel
+            maxsize = self.maxsize
+            for key, value in items:
+                link = cache.get(key)
+                if link is None:
+                    if len(cache) >= maxsize:
+                        if not cache:
+                            # maxsize 0; __setitem__ knows what to do
+                            self[key] = value
+                            continue
+                        self.remove_oldest()
+                        # the evicted link is the new root
+                        root = self.root
+                    link = [ sentinel, sentinel, key, value ]
+                    cache[key] = link
+                    self.insertions += 1
+                else:
+                    link_prev = link[0]
+                    link_next = link[1]
+                    link_prev[1] = link_next
+                    link_next[0] = link_prev
+                    link[3] = value
+                    self.updates += 1
+                last = root[0]
+                last[1] = root[0] = link
+                link[0] = last
+                link[1] = root
+            if len(cache) > self.peak_size:
+                self.peak_size = len(cache)
+
+    def _set_each(self, items):
+        # set_many for subclasses whose entries need more than a plain link
+        with self.lock:
+            self.update(items)
+
+    def pop_many(self, keys):
+        """Remove several keys, taking the lock only once. Returns a dict of the
+        removed keys and their values and a list of the keys that were not
+        present. Popping doesn't count as a lookup."""
+        found = {}
+        missing = []
+        with self.lock:
+            cache = self.cache
+            remove_link = self._remove_link
+            for key in keys:
+                link = cache.pop(key, None)
+                if link is None:
+                    missing.append(key)
+                else:
+                    remove_link(link)
+                    found[key] = link[3]
+        return found, missing
 
     def resize(self, newsize):
         _len = len
@@ -137,6 +337,68 @@ class LRUDict(MutableMapping):
                 self.remove_oldest()
             self.maxsize = newsize
 
+    def dump(self, path):
+        """Write the entries to path, oldest first, as a single pickle. The
+        file is written under a temporary name and renamed into place, so a
+        reader never sees a partial snapshot."""
+        with self.lock:
+            snapshot = self._snapshot()
+        directory = os.path.dirname(os.path.abspath(path))
+        with NamedTemporaryFile(dir=directory, delete=False) as f:
+            try:
+                cPickle.dump(snapshot, f, cPickle.HIGHEST_PROTOCOL)
+            except:
+                os.unlink(f.name)
+                raise
+        os.rename(f.name, path)
+
+    def load(self, path, use_mmap=False):
+        """Add the entries written by dump() to this dict, rebuilding their
+        recency order. If the snapshot holds more than maxsize entries, only
+        the most recent ones are loaded. With use_mmap, the file is copied
+        out of a read-only memory map in one go and unpickled from memory,
+        which is faster than unpickling through the file's buffered reads
+        for large snapshots. The cyclic garbage collector is paused while
+        loading, because the millions of new containers would otherwise
+        trigger it over and over. Returns the number of entries loaded."""
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            with open(path, "rb") as f:
+                if use_mmap:
+                    m = mmap(f.fileno(), 0, access=ACCESS_READ)
+                    try:
+                        snapshot = cPickle.loads(m[:])
+                    finally:
+                        m.close()
+                else:
+                    snapshot = cPickle.load(f)
+            return self._restore(snapshot)
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    def _snapshot(self):
+        # what dump() pickles; the caller holds the lock
+        keys = []
+        values = []
+        root = self.root
+        link = root[1]
+        while link is not root:
+            keys.append(link[2])
+            values.append(link[3])
+            link = link[1]
+        return keys, values
+
+    def _restore(self, snapshot):
+        # load() the entries of an unpickled snapshot; returns their number
+        keys, values = snapshot[:2]
+        with self.lock:
+            start = max(len(keys) - self.maxsize, 0)
+            self.set_many(izip(islice(keys, start, None),
+                              islice(values, start, None)))
+        return len(keys) - start
+
     def __iter__(self):
         return self.cache.iterkeys()
 
@@ -165,6 +427,752 @@ class LRUDict(MutableMapping):
             line[1] = sentinel
 
 
+class TTLLRUDict(LRUDict):
+    """A LRUDict whose entries expire ttl seconds after they were last
+    written. Each link carries its expiry time as a fifth element. Expired
+    entries are evicted lazily when they are looked up, or all at once by
+    purge_expired(). Expired lookups count towards both misses and
+    expirations. Iterating skips expired entries without evicting them, and
+    doesn't count as lookups."""
+    __slots__ = LRUDict.__slots__ + ["ttl", "expirations"]
+    clock = staticmethod(time)
+    def __init__(self, ttl, maxsize=1024, *args, **kwargs):
+        self.ttl = ttl
+        self.expirations = 0
+        super(TTLLRUDict, self).__init__(maxsize)
+        # the root gets recycled as a link by replace_oldest, so it needs
+        # room for an expiry time too
+        self.root.append(self.sentinel)
+        self.update(*args, **kwargs)
+
+    def _make_link(self, key, value):
+        sup = super(TTLLRUDict, self)
+        link = sup._make_link(key, value)
+        link.append(self.sentinel)
+        return link
+
+    def _expire(self, link):
+        with self.lock:
+            key = link[2]
+            value = link[3]
+            LRUDict.__delitem__(self, key)
+            self.expirations += 1
+            self._evicted(key, value, "expired")
+
+    def __getitem__(self, key):
+        with self.lock:
+            link = self.cache.get(key)
+            if link is not None and link[4] <= self.clock():
+                self._expire(link)
+                self.misses += 1
+                if self.window is not None:
+                    self.window.append(False)
+                raise KeyError(key)
+            return super(TTLLRUDict, self).__getitem__(key)
+
+    def get_many(self, keys):
+        keys = list(keys)
+        with self.lock:
+            cache = self.cache
+            now = self.clock()
+            for key in keys:
+                link = cache.get(key)
+                if link is not None and link[4] <= now:
+                    # the miss is counted by LRUDict.get_many
+                    self._expire(link)
+            return super(TTLLRUDict, self).get_many(keys)
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            super(TTLLRUDict, self).__setitem__(key, value)
+            link = self.cache.get(key)
+            if link is not None:
+                link[4] = self.clock() + self.ttl
+
+    # entries need expiry times
+    set_many = LRUDict._set_each.im_func
+
+    def pop_many(self, keys):
+        keys = list(keys)
+        with self.lock:
+            cache = self.cache
+            now = self.clock()
+            for key in keys:
+                link = cache.get(key)
+                if link is not None and link[4] <= now:
+                    # expired entries are missing, as far as pop_many goes
+                    self._expire(link)
+            return super(TTLLRUDict, self).pop_many(keys)
+
+    def _snapshot(self):
+        # the expiry times are stored as read from clock, which by default
+        # is time.time, so they still mean the same thing after a restart
+        keys, values = super(TTLLRUDict, self)._snapshot()
+        root = self.root
+        expiries = []
+        link = root[1]
+        while link is not root:
+            expiries.append(link[4])
+            link = link[1]
+        return keys, values, expiries
+
+    def _restore(self, snapshot):
+        if len(snapshot) < 3:
+            # a plain LRUDict's snapshot, so the entries get a fresh ttl
+            return super(TTLLRUDict, self)._restore(snapshot)
+        keys, values, expiries = snapshot
+        with self.lock:
+            # entries that expired while they were on disk stay expired
+            now = self.clock()
+            live = [ i for i, expiry in enumerate(expiries) if expiry > now ]
+            live = live[max(len(live) - self.maxsize, 0):]
+            cache = self.cache
+            for i in live:
+                key = keys[i]
+                self[key] = values[i]
+                link = cache.get(key)
+                if link is not None:
+                    link[4] = expiries[i]
+        return len(live)
+
+    def purge_expired(self):
+        """Evict every expired entry. Returns the number of entries evicted."""
+        with self.lock:
+            now = self.clock()
+            root = self.root
+            expired = []
+            link = root[1]
+            while link is not root:
+                if link[4] <= now:
+                    expired.append(link)
+                link = link[1]
+            for link in expired:
+                self._expire(link)
+            return len(expired)
+
+    def items(self):
+        # read from the links, because going through __getitem__ would
+        # expire entries (and raise KeyError) as we go
+        with self.lock:
+            now = self.clock()
+            items = []
+            root = self.root
+            link = root[1]
+            while link is not root:
+                if link[4] > now:
+                    items.append((link[2], link[3]))
+                link = link[1]
+            return items
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def keys(self):
+        return [ key for key, _ in self.items() ]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    iterkeys = __iter__
+
+    def values(self):
+        return [ value for _, value in self.items() ]
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def clear(self):
+        with self.lock:
+            sentinel = self.sentinel
+            cache = self.cache
+            for link in cache.itervalues():
+                link[0] = sentinel
+                link[1] = sentinel
+            cache.clear()
+            root = self.root
+            root[0] = root[1] = root
+
+    def __copy__(self):
+        with self.lock:
+            snapshot = self._snapshot()
+        new = type(self)(self.ttl, self.maxsize)
+        new._restore(snapshot)
+        return new
+
+    def __deepcopy__(self, memo):
+        with self.lock:
+            keys, values, expiries = self._snapshot()
+        new = type(self)(self.ttl, self.maxsize)
+        new._restore((deepcopy(keys, memo), deepcopy(values, memo), expiries))
+        return new
+
+
+class WeightedLRUDict(LRUDict):
+    """A LRUDict bounded by the total weight of its entries rather than (or
+    as well as) by their number. weigher(key, value) gives the weight of an
+    entry, which each link carries as a fifth element. When the total weight
+    exceeds max_weight, the oldest entries are evicted until it fits.
+    Entries that are heavier than max_weight on their own are not stored."""
+    __slots__ = LRUDict.__slots__ + ["max_weight", "weigher", "weight"]
+    def __init__(self, max_weight, weigher, maxsize=sys.maxsize, *args, **kwargs):
+        self.max_weight = max_weight
+        self.weigher = weigher
+        self.weight = 0
+        super(WeightedLRUDict, self).__init__(maxsize)
+        # the root gets recycled as a link by replace_oldest, so it needs
+        # room for a weight too
+        self.root.append(0)
+        self.update(*args, **kwargs)
+
+    def _make_link(self, key, value):
+        sup = super(WeightedLRUDict, self)
+        link = sup._make_link(key, value)
+        link.append(0)
+        return link
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            weight = self.weigher(key, value)
+            cache = self.cache
+            if weight > self.max_weight:
+                if key in cache:
+                    del self[key]
+                return
+            super(WeightedLRUDict, self).__setitem__(key, value)
+            link = cache.get(key)
+            if link is not None:
+                self.weight += weight - link[4]
+                link[4] = weight
+                self._shed_weight(self.max_weight)
+
+    def _shed_weight(self, max_weight):
+        with self.lock:
+            while self.weight > max_weight:
+                self.remove_oldest("weight")
+
+    def replace_oldest(self, key, value):
+        with self.lock:
+            # when we're empty (maxsize 0), root[1] is the root itself, and
+            # its weight is left over from whichever link it used to be
+            if self.cache:
+                self.weight -= self.root[1][4]
+            super(WeightedLRUDict, self).replace_oldest(key, value)
+            # the recycled link now belongs to key, which hasn't been weighed;
+            # with maxsize 0, key was evicted again straight away
+            link = self.cache.get(key)
+            if link is not None:
+                link[4] = 0
+
+    def remove_oldest(self, reason="size"):
+        with self.lock:
+            if not self.cache:
+                raise KeyError("remove_oldest(): %s is empty" % type(self).__name__)
+            self.weight -= self.root[1][4]
+            super(WeightedLRUDict, self).remove_oldest(reason)
+
+    def _remove_link(self, link):
+        with self.lock:
+            super(WeightedLRUDict, self)._remove_link(link)
+            self.weight -= link[4]
+
+    # entries need weighing
+    set_many = LRUDict._set_each.im_func
+
+    def resize_weight(self, new_max_weight):
+        with self.lock:
+            self._shed_weight(new_max_weight)
+            self.max_weight = new_max_weight
+
+    def __copy__(self):
+        return type(self)(self.max_weight, self.weigher, self.maxsize,
+                          self.iteritems())
+
+    def __deepcopy__(self, memo):
+        return type(self)(self.max_weight, self.weigher, self.maxsize,
+                          imap(lambda (k,v): (deepcopy(k, memo), deepcopy(v, memo)),
+                               self.iteritems()))
+
+
+class BufferedLRUDict(LRUDict):
+    """A LRUDict whose hits don't take the lock. A hit is a plain dict read;
+    the link is appended to a buffer belonging to the current thread, and
+    the recency list is reordered from all of the buffers in one batch when
+    a buffer fills up or when the dict is written to. If the lock is busy
+    when a buffer fills up, the batch is left for later rather than
+    waiting. hits only counts lookups that have been applied from the
+    buffers, so it may lag behind by up to read_buffer_size per thread, and
+    hits still buffered when a thread exits are dropped.
+
+    Links are never recycled by replace_oldest, so a reader that races with
+    an eviction either sees the live value or sees the sentinel and falls
+    back to the locked lookup."""
+    __slots__ = LRUDict.__slots__ + ["local", "buffers"]
+    read_buffer_size = 64
+    def __init__(self, maxsize=1024, *args, **kwargs):
+        self.local = local()
+        self.buffers = WeakValueDictionary()
+        super(BufferedLRUDict, self).__init__(maxsize, *args, **kwargs)
+
+    def _read_buffer(self):
+        try:
+            return self.local.buffer
+        except AttributeError:
+            buffer = self.local.buffer = deque()
+            with self.lock:
+                # thread-local storage is dropped when its thread exits, so
+                # this entry goes away with the thread
+                self.buffers[id(buffer)] = buffer
+            return buffer
+
+    def drain(self, blocking=True):
+        """Apply the buffered hits to the recency list."""
+        lock = self.lock
+        if not lock.acquire(blocking):
+            return
+        try:
+            cache = self.cache
+            mark = self._mark_recent_use
+            drained = 0
+            for buffer in self.buffers.values():
+                popleft = buffer.popleft
+                while True:
+                    try:
+                        link = popleft()
+                    except IndexError:
+                        break
+                    drained += 1
+                    # skip links that were evicted after the hit
+                    if cache.get(link[2]) is link:
+                        mark(link)
+            self.hits += drained
+            if self.window is not None:
+                self.window.extend(repeat(True, drained))
+        finally:
+            lock.release()
+
+    def __getitem__(self, key):
+        link = self.cache.get(key)
+        if link is not None:
+            value = link[3]
+            if value is not self.sentinel:
+                buffer = self._read_buffer()
+                buffer.append(link)
+                if len(buffer) >= self.read_buffer_size:
+                    self.drain(False)
+                return value
+        return super(BufferedLRUDict, self).__getitem__(key)
+
+    def get_many(self, keys):
+        with self.lock:
+            self.drain()
+            return super(BufferedLRUDict, self).get_many(keys)
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.drain()
+            super(BufferedLRUDict, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        with self.lock:
+            self.drain()
+            super(BufferedLRUDict, self).__delitem__(key)
+
+    def set_many(self, items):
+        with self.lock:
+            self.drain()
+            super(BufferedLRUDict, self).set_many(items)
+
+    def pop_many(self, keys):
+        with self.lock:
+            self.drain()
+            return super(BufferedLRUDict, self).pop_many(keys)
+
+    def replace_oldest(self, key, value):
+        with self.lock:
+            if not self.cache:
+                # nothing to replace; we can't hold any entries
+                return
+            self.remove_oldest()
+            self._add_new(self._make_link(key, value))
+
+    def resize(self, newsize):
+        with self.lock:
+            self.drain()
+            super(BufferedLRUDict, self).resize(newsize)
+
+
+class CompactLRUDict(MutableMapping):
+    """A LRUDict that keeps its doubly-linked list in preallocated arrays of
+    slot indices instead of in a 4-element list per entry. Keys and values
+    live in parallel lists indexed by slot, and slot 0 is the root of the
+    list. Entries cost a fraction of the memory of a LRUDict link, and the
+    only containers the garbage collector has to traverse are the key and
+    value lists."""
+    __slots__ = ["sentinel", "maxsize", "hits", "misses", "lock", "cache",
+                 "prev_slot", "next_slot", "slot_keys", "slot_values", "free"]
+    def __init__(self, maxsize=1024, *args, **kwargs):
+        self.sentinel = object()
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.lock = RLock()
+        self.cache = {}
+        self._allocate(maxsize)
+        self.update(*args, **kwargs)
+
+    def _allocate(self, maxsize):
+        # (re)build the slot arrays with room for maxsize entries, laying
+        # out the existing entries in recency order
+        sentinel = self.sentinel
+        size = maxsize + 1
+        prev_slot = array('l', [0]) * size
+        next_slot = array('l', [0]) * size
+        slot_keys = [sentinel] * size
+        slot_values = [sentinel] * size
+        cache = self.cache
+        if cache:
+            old_next = self.next_slot
+            old_keys = self.slot_keys
+            old_values = self.slot_values
+            old = old_next[0]
+            new = 0
+            while old:
+                new += 1
+                key = old_keys[old]
+                slot_keys[new] = key
+                slot_values[new] = old_values[old]
+                cache[key] = new
+                prev_slot[new] = new - 1
+                next_slot[new - 1] = new
+                old = old_next[old]
+            prev_slot[0] = new
+        self.prev_slot = prev_slot
+        self.next_slot = next_slot
+        self.slot_keys = slot_keys
+        self.slot_values = slot_values
+        self.free = range(maxsize, len(cache), -1)
+
+    def _mark_recent_use(self, slot):
+        with self.lock:
+            prev_slot = self.prev_slot
+            next_slot = self.next_slot
+            slot_prev = prev_slot[slot]
+            slot_next = next_slot[slot]
+            next_slot[slot_prev] = slot_next
+            prev_slot[slot_next] = slot_prev
+            last = prev_slot[0]
+            next_slot[last] = prev_slot[0] = slot
+            prev_slot[slot] = last
+            next_slot[slot] = 0
+
+    def __getitem__(self, key):
+        with self.lock:
+            try:
+                slot = self.cache[key]
+                self._mark_recent_use(slot)
+                self.hits += 1
+                return self.slot_values[slot]
+            except KeyError:
+                self.misses += 1
+                raise
+
+    def _add_new(self, key, value):
+        with self.lock:
+            slot = self.free.pop()
+            self.slot_keys[slot] = key
+            self.slot_values[slot] = value
+            self.cache[key] = slot
+            prev_slot = self.prev_slot
+            next_slot = self.next_slot
+            last = prev_slot[0]
+            next_slot[last] = prev_slot[0] = slot
+            prev_slot[slot] = last
+            next_slot[slot] = 0
+
+    def replace_oldest(self, key, value):
+        with self.lock:
+            slot = self.next_slot[0]
+            if not slot:
+                # nothing to replace; we can't hold any entries
+                return
+            cache = self.cache
+            slot_keys = self.slot_keys
+            del cache[slot_keys[slot]]
+            cache[key] = slot
+            slot_keys[slot] = key
+            self.slot_values[slot] = value
+            self._mark_recent_use(slot)
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            slot = self.cache.get(key)
+            if slot is None:
+                maxsize = self.maxsize
+                length = len(self.cache)
+                if length == maxsize:
+                    self.replace_oldest(key, value)
+                elif length < maxsize:
+                    self._add_new(key, value)
+                else:
+                    raise RuntimeError("CompactLRUDict size exceeds maximum size")
+            else:
+                self.slot_values[slot] = value
+                self._mark_recent_use(slot)
+
+    def _remove_slot(self, slot):
+        with self.lock:
+            prev_slot = self.prev_slot
+            next_slot = self.next_slot
+            slot_prev = prev_slot[slot]
+            slot_next = next_slot[slot]
+            next_slot[slot_prev] = slot_next
+            prev_slot[slot_next] = slot_prev
+            sentinel = self.sentinel
+            self.slot_keys[slot] = sentinel
+            self.slot_values[slot] = sentinel
+            self.free.append(slot)
+
+    def __delitem__(self, key):
+        with self.lock:
+            self._remove_slot(self.cache.pop(key))
+
+    def remove_oldest(self):
+        with self.lock:
+            slot = self.next_slot[0]
+            if not slot:
+                raise KeyError("remove_oldest(): %s is empty" % type(self).__name__)
+            del self.cache[self.slot_keys[slot]]
+            self._remove_slot(slot)
+
+    def get_many(self, keys):
+        """Look up several keys, taking the lock and relinking the list once
+        for the whole batch. Returns a dict of the keys that were found and a
+        list of the keys that were not."""
+        found = {}
+        missing = []
+        with self.lock:
+            cache = self.cache
+            prev_slot = self.prev_slot
+            next_slot = self.next_slot
+            slot_values = self.slot_values
+            hits = 0
+            for key in keys:
+                slot = cache.get(key)
+                if slot is None:
+                    missing.append(key)
+                    continue
+                slot_prev = prev_slot[slot]
+                slot_next = next_slot[slot]
+                next_slot[slot_prev] = slot_next
+                prev_slot[slot_next] = slot_prev
+                last = prev_slot[0]
+                next_slot[last] = prev_slot[0] = slot
+                prev_slot[slot] = last
+                next_slot[slot] = 0
+                found[key] = slot_values[slot]
+                hits += 1
+            self.hits += hits
+            self.misses += len(missing)
+        return found, missing
+
+    set_many = LRUDict._set_each.im_func
+
+    def pop_many(self, keys):
+        """Remove several keys, taking the lock only once. Returns a dict of the
+        removed keys and their values and a list of the keys that were not
+        present. Popping doesn't count as a lookup."""
+        found = {}
+        missing = []
+        with self.lock:
+            cache = self.cache
+            slot_values = self.slot_values
+            for key in keys:
+                slot = cache.pop(key, None)
+                if slot is None:
+                    missing.append(key)
+                else:
+                    found[key] = slot_values[slot]
+                    self._remove_slot(slot)
+        return found, missing
+
+    def resize(self, newsize):
+        _len = len
+        with self.lock:
+            while _len(self.cache) > newsize:
+                self.remove_oldest()
+            self._allocate(newsize)
+            self.maxsize = newsize
+
+    def __iter__(self):
+        return self.cache.iterkeys()
+
+    def __len__(self):
+        return len(self.cache)
+
+    def __repr__(self):
+        return "%s.%s(%s)" % (type(self).__module__,
+                              type(self).__name__,
+                              repr(dict(self.iteritems())))
+
+    def __copy__(self):
+        return type(self)(self.maxsize, self.iteritems())
+
+    def __deepcopy__(self, memo):
+        return type(self)(self.maxsize,
+                          imap(lambda (k,v): (deepcopy(k, memo), deepcopy(v, memo)),
+                               self.iteritems()))
+
+
+class ShardedLRUDict(MutableMapping):
+    """A mapping that spreads its keys across several independent LRUDicts
+    according to their hash. Each shard has its own lock and its own
+    recency list, so threads working on different keys rarely contend with
+    each other. The price is that eviction is only least-recently-used
+    within a shard, not across the whole mapping."""
+    __slots__ = ["shards", "maxsize"]
+    def __init__(self, maxsize=1024, nshards=16, *args, **kwargs):
+        self.shards = tuple(LRUDict(size)
+                            for size in self._split_size(maxsize, nshards))
+        self.maxsize = maxsize
+        self.update(*args, **kwargs)
+
+    @staticmethod
+    def _split_size(size, nshards):
+        quotient, remainder = divmod(size, nshards)
+        return [ quotient + 1 if i < remainder else quotient
+                 for i in xrange(nshards) ]
+
+    def _shard(self, key):
+        shards = self.shards
+        return shards[hash(key) % len(shards)]
+
+    def __getitem__(self, key):
+        return self._shard(key)[key]
+
+    def __setitem__(self, key, value):
+        self._shard(key)[key] = value
+
+    def __delitem__(self, key):
+        del self._shard(key)[key]
+
+    def _group(self, keys):
+        shards = self.shards
+        nshards = len(shards)
+        groups = [ [] for _ in shards ]
+        for key in keys:
+            groups[hash(key) % nshards].append(key)
+        return zip(shards, groups)
+
+    def get_many(self, keys):
+        """Look up several keys, taking each shard's lock once. Returns a dict
+        of the keys that were found and a list of the keys that were not."""
+        found = {}
+        missing = []
+        for shard, group in self._group(keys):
+            if group:
+                shard_found, shard_missing = shard.get_many(group)
+                found.update(shard_found)
+                missing.extend(shard_missing)
+        return found, missing
+
+    def set_many(self, items):
+        """Store a mapping or an iterable of (key, value) pairs, taking each
+        shard's lock once."""
+        if isinstance(items, Mapping):
+            items = items.iteritems()
+        shards = self.shards
+        nshards = len(shards)
+        groups = [ [] for _ in shards ]
+        for item in items:
+            groups[hash(item[0]) % nshards].append(item)
+        for shard, group in zip(shards, groups):
+            if group:
+                shard.set_many(group)
+
+    def pop_many(self, keys):
+        """Remove several keys, taking each shard's lock once. Returns a dict
+        of the removed keys and their values and a list of the keys that
+        were not present."""
+        found = {}
+        missing = []
+        for shard, group in self._group(keys):
+            if group:
+                shard_found, shard_missing = shard.pop_many(group)
+                found.update(shard_found)
+                missing.extend(shard_missing)
+        return found, missing
+
+    @property
+    def hits(self):
+        return sum(shard.hits for shard in self.shards)
+
+    @property
+    def misses(self):
+        return sum(shard.misses for shard in self.shards)
+
+    @property
+    def on_evict(self):
+        return self.shards[0].on_evict
+
+    @on_evict.setter
+    def on_evict(self, callback):
+        for shard in self.shards:
+            shard.on_evict = callback
+
+    def instrument(self, window=1024, time_lock=True):
+        """As LRUDict.instrument, applied to each shard. The window is split
+        evenly between the shards."""
+        shards = self.shards
+        for shard, size in zip(shards, self._split_size(window, len(shards))):
+            shard.instrument(size, time_lock)
+
+    def stats(self):
+        """Returns a LRUStats snapshot summed over the shards. peak_size is the
+        sum of the shards' peak sizes, so it may overestimate."""
+        all_stats = [ shard.stats() for shard in self.shards ]
+        def total(field):
+            values = [ getattr(stats, field) for stats in all_stats ]
+            if None in values:
+                return None
+            return sum(values)
+        windows = [ shard.window for shard in self.shards
+                    if shard.window ]
+        if windows:
+            window_hit_ratio = float(sum(imap(sum, windows))) \
+                               / sum(imap(len, windows))
+        else:
+            window_hit_ratio = None
+        return LRUStats(total("hits"), total("misses"), total("evictions"),
+                        total("insertions"), total("updates"), total("size"),
+                        total("peak_size"), self.maxsize, total("lock_wait"),
+                        window_hit_ratio)
+
+    def resize(self, newsize):
+        shards = self.shards
+        for shard, size in zip(shards, self._split_size(newsize, len(shards))):
+            shard.resize(size)
+        self.maxsize = newsize
+
+    def __iter__(self):
+        return chain.from_iterable(self.shards)
+
+    def __len__(self):
+        return sum(imap(len, self.shards))
+
+    def __repr__(self):
+        return "%s.%s(%s)" % (type(self).__module__,
+                              type(self).__name__,
+                              repr(dict(self.iteritems())))
+
+    def __copy__(self):
+        return type(self)(self.maxsize, len(self.shards), self.iteritems())
+
+    def __deepcopy__(self, memo):
+        return type(self)(self.maxsize, len(self.shards),
+                          imap(lambda (k,v): (deepcopy(k, memo), deepcopy(v, memo)),
+                               self.iteritems()))
+
+
 class IterationGuard(object):
     """
     This class taken directly from the CPython _weakrefset.py module.
@@ -197,20 +1205,14 @@ class IterationGuard(object):
 
 class WeakKeyLRUDict(LRUDict):
     """A LRUDict that holds its references to its keys weakly.
-    Patterned after weakref.WeakKeyDictionary, and much code taken from there."""
+    Patterned after weakref.WeakKeyDictionary, and much code taken from there.
+    on_evict is passed the key itself, or None if the key has already died."""
     __slots__ = LRUDict.__slots__ + ["_remove", "_pending_removals", "_iterating"]
     def __init__(self, *args, **kwargs):
         def remove(k, selfref=ref(self)):
             self = selfref()
             if self is not None:
-                if self._iterating:
-                    self._pending_removals.append(k)
-                else:
-                    try:
-                        sup = super(WeakKeyLRUDict, self)
-                        sup.__delitem__(k)
-                    except KeyError:
-                        pass
+                self._key_died(k)
         self._remove = remove
         self._pending_removals = []
         self._iterating = set()
@@ -223,25 +1225,60 @@ class WeakKeyLRUDict(LRUDict):
         # However, it means keys may already have been removed.
         l = self._pending_removals
         while l:
-            try:
-                del self[l.pop()]
-            except KeyError:
-                pass
+            self._remove_ref(l.pop())
+
+    def _key_died(self, wr):
+        # called from the weakref callback
+        if self._iterating:
+            self._pending_removals.append(wr)
+        else:
+            self._remove_ref(wr)
+
+    def _remove_ref(self, wr):
+        # wr is (or was) one of our keys and its referent has died
+        try:
+            LRUDict.__delitem__(self, wr)
+        except KeyError:
+            pass
+
+    def _make_ref(self, key):
+        return ref(key, self._remove)
+
+    def _evicted(self, wr, value, reason):
+        sup = super(WeakKeyLRUDict, self)
+        sup._evicted(wr(), value, reason)
 
     def __getitem__(self, key):
         sup = super(WeakKeyLRUDict, self)
         return sup.__getitem__(ref(key))
 
+    def __setitem__(self, key, value):
+        with self.lock:
+            link = self.cache.get(ref(key))
+            sup = super(WeakKeyLRUDict, self)
+            if link is None:
+                sup.__setitem__(key, value)
+            else:
+                # update the existing entry through the ref we already hold
+                sup.__setitem__(link[2], value)
+
     def _make_link(self, key, value):
-        key = ref(key, self._remove)
+        key = self._make_ref(key)
         sup = super(WeakKeyLRUDict, self)
         return sup._make_link(key, value)
 
     def replace_oldest(self, key, value):
-        key = ref(key, self._remove)
+        key = self._make_ref(key)
         sup = super(WeakKeyLRUDict, self)
         return sup.replace_oldest(key, value)
 
+    def get_many(self, keys):
+        sup = super(WeakKeyLRUDict, self)
+        keys = list(keys)
+        found, missing = sup.get_many(imap(ref, keys))
+        return (dict((wr(), value) for wr, value in found.iteritems()),
+                [ wr() for wr in missing ])
+
     def __delitem__(self, key):
         key = ref(key)
         sup = super(WeakKeyLRUDict, self)
@@ -255,6 +1292,43 @@ class WeakKeyLRUDict(LRUDict):
                 if obj is not None:
                     yield obj
 
+    # entries need weakrefs to their keys
+    set_many = LRUDict._set_each.im_func
+
+    def pop_many(self, keys):
+        sup = super(WeakKeyLRUDict, self)
+        keys = list(keys)
+        found, missing = sup.pop_many(imap(ref, keys))
+        return (dict((wr(), value) for wr, value in found.iteritems()),
+                [ wr() for wr in missing ])
+
+    def _snapshot(self):
+        # pickle the keys themselves, leaving out the ones that have died
+        keys = []
+        values = []
+        root = self.root
+        link = root[1]
+        while link is not root:
+            key = link[2]()
+            if key is not None:
+                keys.append(key)
+                values.append(link[3])
+            link = link[1]
+        return keys, values
+
+    def _restore(self, snapshot):
+        # After load(), an entry only lasts as long as something else keeps
+        # its key alive, which most unpickled keys don't (classes and
+        # functions do: they unpickle to the existing objects). Drop the
+        # snapshot's references and count the entries that survive.
+        keys, values = snapshot[:2]
+        with self.lock:
+            start = max(len(keys) - self.maxsize, 0)
+            refs = map(ref, islice(keys, start, None))
+            super(WeakKeyLRUDict, self)._restore(snapshot)
+            del keys[:], values[:]
+            return sum(1 for wr in refs if wr() is not None)
+
     def iterkeyrefs(self):
         sup = super(WeakKeyLRUDict, self)
         with IterationGuard(self):
@@ -264,4 +1338,130 @@ class WeakKeyLRUDict(LRUDict):
     def keyrefs(self):
         return list(self.iterkeyrefs())
 
-__all__ = ["LRUDict", "WeakKeyLRUDict"]
+
+class DeferredWeakKeyLRUDict(WeakKeyLRUDict):
+    """A WeakKeyLRUDict that never takes its lock from a weakref callback.
+    When a key dies, the callback only appends its weakref to
+    _pending_removals (list.append is atomic), so a garbage collection
+    triggered in some other thread doesn't contend for the lock. The
+    pending removals are applied in one batch at the start of the next
+    mutation, or periodically by the thread that start_reaper() starts.
+    Until then, dead entries still count towards len() and maxsize."""
+    __slots__ = WeakKeyLRUDict.__slots__
+    def _key_died(self, wr):
+        self._pending_removals.append(wr)
+
+    def drain(self):
+        """Apply the pending removals, unless the dict is being iterated."""
+        if self._pending_removals:
+            with self.lock:
+                if not self._iterating:
+                    self._commit_removals()
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.drain()
+            super(DeferredWeakKeyLRUDict, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        with self.lock:
+            self.drain()
+            super(DeferredWeakKeyLRUDict, self).__delitem__(key)
+
+    def pop_many(self, keys):
+        with self.lock:
+            self.drain()
+            return super(DeferredWeakKeyLRUDict, self).pop_many(keys)
+
+    def resize(self, newsize):
+        with self.lock:
+            self.drain()
+            super(DeferredWeakKeyLRUDict, self).resize(newsize)
+
+    def start_reaper(self, interval=1.0):
+        """Start a daemon thread that calls drain() every interval seconds. The
+        thread only holds a weak reference to the dict and exits once the
+        dict has been collected. Returns the thread."""
+        def reap(selfref=ref(self)):
+            while True:
+                sleep(interval)
+                self = selfref()
+                if self is None:
+                    return
+                self.drain()
+                del self
+        reaper = Thread(target=reap, name="%s reaper" % type(self).__name__)
+        reaper.daemon = True
+        reaper.start()
+        return reaper
+
+
+class CachedRefWeakKeyLRUDict(WeakKeyLRUDict):
+    """A WeakKeyLRUDict that doesn't allocate a weakref to look up a key that
+    it holds. CPython hands out the same callback-free weakref to an object
+    for as long as one exists, so by keeping a callback-free weakref to each
+    of its keys alive, this dict makes the ref(key) in a lookup return that
+    existing weakref instead of building a new one."""
+    __slots__ = WeakKeyLRUDict.__slots__ + ["probe_refs"]
+    def __init__(self, *args, **kwargs):
+        self.probe_refs = {}
+        super(CachedRefWeakKeyLRUDict, self).__init__(*args, **kwargs)
+
+    def _make_ref(self, key):
+        wr = super(CachedRefWeakKeyLRUDict, self)._make_ref(key)
+        self.probe_refs[wr] = ref(key)
+        return wr
+
+    def _forget(self, wr):
+        # wr is one of our keys; drop the weakref we keep for probing
+        self.probe_refs.pop(wr, None)
+
+    def _remove_link(self, link):
+        with self.lock:
+            super(CachedRefWeakKeyLRUDict, self)._remove_link(link)
+            self._forget(link[2])
+
+    def _evicted(self, wr, value, reason):
+        self._forget(wr)
+        super(CachedRefWeakKeyLRUDict, self)._evicted(wr, value, reason)
+
+
+def _benchmark_weak_lookups(size=10000, lookups=1000000):
+    """Time lookups of live keys in a WeakKeyLRUDict and a
+    CachedRefWeakKeyLRUDict, both through __getitem__ and by probing the
+    underlying dict the way __getitem__ does. Returns a list of (class name,
+    __getitem__ seconds, probe seconds) tuples."""
+    from timeit import default_timer
+    class Key(object):
+        __slots__ = ["__weakref__"]
+    keys = [ Key() for _ in xrange(size) ]
+    probes = [ keys[i % size] for i in xrange(lookups) ]
+    results = []
+    for cls in (WeakKeyLRUDict, CachedRefWeakKeyLRUDict):
+        d = cls(size)
+        for key in keys:
+            d[key] = None
+        getitem = d.__getitem__
+        start = default_timer()
+        for key in probes:
+            getitem(key)
+        getitem_time = default_timer() - start
+        cache = d.cache
+        start = default_timer()
+        for key in probes:
+            cache[ref(key)]
+        probe_time = default_timer() - start
+        results.append((cls.__name__, getitem_time, probe_time))
+    return results
+
+
+__all__ = ["LRUDict", "LRUStats", "TimedRLock", "TTLLRUDict", "WeightedLRUDict",
+           "BufferedLRUDict", "CompactLRUDict", "ShardedLRUDict",
+           "WeakKeyLRUDict", "DeferredWeakKeyLRUDict",
+           "CachedRefWeakKeyLRUDict"]
+
+
+if __name__ == '__main__':
+    for name, getitem_time, probe_time in _benchmark_weak_lookups():
+        print "%-24s __getitem__ %.3fs  probe %.3fs" % (name, getitem_time,
+                                                        probe_time)
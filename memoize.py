@@ -14,19 +14,217 @@
 # with stupid_python_tricks.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import sys
 import warnings
-from weakref import WeakKeyDictionary, WeakValueDictionary
-from weakcompoundkey import WeakCompoundKey
-from collections import MutableMapping
-from threading import Lock
+from inspect import getargspec
+from time import time
+from itertools import imap, chain
+from weakref import WeakKeyDictionary
+from weakcompoundkey import LeanWeakCompoundKey, WeakKeyRegistry
+from collections import MutableMapping, namedtuple
+from threading import Lock, Condition
 
 from decorator_decorator import decorator_decorator
+from lru import LRUDict, TTLLRUDict
+from cache_policies import TinyLFUDict
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+MemoProfile = namedtuple("MemoProfile", ["name", "calls", "hits", "misses",
+                                         "time_saved", "currsize", "bytes"])
+
+# While profiling is enabled, every function that gets memoized or
+# weakmemoized registers a closure here that returns its MemoProfile, and
+# misses are timed (two calls to time() each), which is what time_saved is
+# estimated from. Hits and misses are always counted, since that's just an
+# increment.
+_profiled = WeakKeyDictionary()
+_profiling = False
+
+def enable_profiling(enabled=True):
+    """Start (or, with enabled=False, stop) profiling memoized and
+    weakmemoized functions, so that report can show how much time and
+    memory each cache costs or saves. Only functions memoized while
+    profiling is enabled are registered, so enable it before importing the
+    modules you want to profile. Disabling it stops timing misses, but
+    keeps the functions registered so far."""
+    global _profiling
+    _profiling = enabled
+
+def _approximate_bytes(cache):
+    """Roughly how much memory the keys and values in cache take, or None
+    if we can't tell. This only looks one level into tuples and frozensets,
+    since that's what our keys are made of.
+
+    Profiling must not disturb the caches it looks at, so this never goes
+    through a cache's __getitem__: that would count hits, refresh recency,
+    expire entries or (for the on-disk backends) do I/O. It only reads
+    dicts and LRUDict links directly."""
+    def size(thing):
+        retval = sys.getsizeof(thing)
+        if isinstance(thing, (tuple, frozenset)):
+            retval += sum(imap(size, thing))
+        return retval
+    if isinstance(cache, dict):
+        items = cache.items()
+    elif isinstance(cache, WeakKeyDictionary):
+        items = cache.data.items()
+    elif isinstance(cache, LRUDict):
+        with cache.lock:
+            items = [(link[2], link[3]) for link in cache.cache.itervalues()]
+    else:
+        return None
+    return sys.getsizeof(cache) \
+           + sum(imap(size, chain.from_iterable(items)))
+
+def _make_profile(f, cache, counts):
+    name = "%s.%s" % (getattr(f, "__module__", None) or "?",
+                      getattr(f, "__name__", None) or repr(f))
+    def profile():
+        hits, misses, uncached, miss_time, timed_misses = counts
+        if timed_misses:
+            time_saved = hits * miss_time / timed_misses
+        else:
+            time_saved = 0.0
+        return MemoProfile(name, hits + misses + uncached, hits, misses,
+                           time_saved, len(cache), _approximate_bytes(cache))
+    return profile
+
+def profile():
+    """Return the MemoProfile of every live memoized and weakmemoized
+    function registered while profiling was enabled, sorted by time saved
+    (then by hits), best first."""
+    return sorted((get_profile() for get_profile in _profiled.values()),
+                  key=lambda p: (p.time_saved, p.hits), reverse=True)
+
+def report(out=None):
+    """Print a table of profile() to out (default stdout). Functions at the
+    bottom with few hits and lots of bytes are costing more than they save."""
+    if out is None:
+        out = sys.stdout
+    if not _profiling:
+        print >>out, "(profiling is disabled, so functions memoized since " \
+                     "aren't listed and time saved is incomplete; see " \
+                     "enable_profiling)"
+    row = "%-40s %10s %10s %10s %7s %12s %10s %12s"
+    print >>out, row % ("function", "calls", "hits", "misses", "hit %",
+                        "saved (s)", "size", "bytes")
+    for p in profile():
+        if p.hits + p.misses:
+            ratio = "%.1f" % (100.0 * p.hits / (p.hits + p.misses))
+        else:
+            ratio = "-"
+        print >>out, row % (p.name[-40:], p.calls, p.hits, p.misses, ratio,
+                            "%.3f" % p.time_saved, p.currsize,
+                            "-" if p.bytes is None else p.bytes)
+
+def _timed_compute_once(counts, *args, **kwargs):
+    start = time()
+    try:
+        return _compute_once(*args, **kwargs)
+    finally:
+        counts[3] += time() - start
+        counts[4] += 1
+
+def make_cache(maxsize=None, policy="lru", ttl=None):
+    """Build a memoization cache. With the lru policy, the cache is a
+    LRUDict of the given maxsize, or an unbounded dict if maxsize is None.
+    The lfu policy gives a TinyLFUDict, which needs a maxsize. The ttl
+    policy gives a TTLLRUDict whose entries expire after ttl seconds,
+    bounded by maxsize if it is given."""
+    if policy == "lru":
+        if maxsize is None:
+            return {}
+        return LRUDict(maxsize)
+    elif policy == "lfu":
+        if maxsize is None:
+            raise ValueError("The lfu policy needs a maxsize")
+        return TinyLFUDict(maxsize)
+    elif policy == "ttl":
+        if ttl is None:
+            raise ValueError("The ttl policy needs a ttl")
+        return TTLLRUDict(ttl, sys.maxsize if maxsize is None else maxsize)
+    else:
+        raise ValueError("Unknown memoization policy %r" % (policy,))
+
+def _cache_maxsize(cache):
+    # what cache_info() reports; like functools.lru_cache, an unbounded
+    # cache (including one bounded only by sys.maxsize) has maxsize None
+    maxsize = getattr(cache, "maxsize", None)
+    if maxsize == sys.maxsize:
+        return None
+    return maxsize
+
+_kwd_mark = object()
+_missing = object()
 
 def format_memo_args(*args, **kwargs):
-    return (args, frozenset(kwargs.iteritems()))
+    if kwargs:
+        return (_kwd_mark, args, frozenset(kwargs.iteritems()))
+    return args
+
+# Callers that miss on the same key wait on the same condition, picked by
+# hash from a fixed pool shared by every memoized function. Nothing is
+# allocated per miss, and nobody holds a stripe while computing or while
+# probing the cache (which may run the key's __eq__, do I/O or call an
+# on_evict hook), so a memoized function can call another one that hashes
+# to the same stripe. Only the pending bookkeeping happens under the lock.
+# The uncontended path only touches the stripe's raw Lock; the (pure
+# python) Condition is only used when somebody actually has to wait.
+_nstripes = 64
+_stripes = tuple((lock, Condition(lock))
+                 for lock in (Lock() for _ in xrange(_nstripes)))
+
+def _compute_once(cache, pending, key, f, args, kwargs, registry=None,
+                  unmemoized=None):
+    """Return cache[key], computing it as f(*args, **kwargs) if it's missing.
+    pending maps the keys being computed to the number of callers waiting
+    for them. Callers that arrive while key is pending wait for the owner
+    instead of calling f again. If the owner raises or the value is evicted
+    before they wake, one of them becomes the new owner. If registry is
+    given, key is registered with it just before it is stored. A cache that
+    doesn't hash its keys (e.g. one that pickles them) lets unhashable keys
+    get this far; for those, we return unmemoized(e, args, kwargs)."""
+    try:
+        lock, cond = _stripes[hash(key) & (_nstripes - 1)]
+    except TypeError as e:
+        if unmemoized is None or not _unhashable(e):
+            raise
+        return unmemoized(e, args, kwargs)
+    while True:
+        retval = cache.get(key, _missing)
+        if retval is not _missing:
+            return retval
+        with lock:
+            if key not in pending:
+                pending[key] = 0
+                break
+            # woken by the owner (or by a neighbour on the same stripe), we
+            # probe the cache again with the lock released
+            pending[key] += 1
+            cond.wait()
+    try:
+        # the previous owner may have stored the value and left between
+        # our probe and our claim
+        retval = cache.get(key, _missing)
+        if retval is not _missing:
+            return retval
+        retval = f(*args, **kwargs)
+        if registry is not None:
+            key.register(registry)
+        cache[key] = retval
+    finally:
+        with lock:
+            if pending.pop(key):
+                cond.notify_all()
+    return retval
+
+def _unhashable(e):
+    return len(e.args) == 1 \
+           and isinstance(e.args[0], basestring) \
+           and e.args[0].startswith("unhashable type:")
 
 @decorator_decorator
-def memoize(f, cache=None):
+def memoize(f=None, cache=None, maxsize=None, policy="lru", ttl=None):
     """memoize memoizes its argument.
     Argument references are strongly held, which can lead to memory leaks.
     If you are concerned about this, use the lower-performance weakmemoize.
@@ -46,7 +244,25 @@ def memoize(f, cache=None):
     def foo(*args, **kwargs):
         ...
 
-    In this case, memoize will use memo_dict to store memoization information."""
+    In this case, memoize will use memo_dict to store memoization information.
+
+    Finally, memoize can build a bounded cache for you (see make_cache):
+
+    @memoize(maxsize=1024)
+    def foo(*args, **kwargs):
+        ...
+
+    @memoize(maxsize=1024, policy="lfu")
+    def foo(*args, **kwargs):
+        ...
+
+    @memoize(ttl=60, policy="ttl")
+    def foo(*args, **kwargs):
+        ...
+
+    The memoized function has a cache_info() method that reports hits,
+    misses, maxsize and currsize like functools.lru_cache, and a clear()
+    method that empties the cache and resets the counts."""
     if isinstance(f, MutableMapping):
         assert cache is None
         @decorator_decorator
@@ -54,57 +270,113 @@ def memoize(f, cache=None):
             return memoize(new_f, cache=f)
         return memoize_with_cache
 
+    if f is None:
+        @decorator_decorator
+        def memoize_with_options(new_f):
+            return memoize(new_f, cache, maxsize, policy, ttl)
+        return memoize_with_options
+
     if cache is None:
-        cache = {}
-    pending = WeakValueDictionary()
+        cache = make_cache(maxsize, policy, ttl)
+    pending = {}
+    # hits, misses, uncached calls, seconds spent on timed misses, timed misses
+    counts = [0, 0, 0, 0.0, 0]
 
-    def memoized(*args, **kwargs):
-        try:
-            key = format_memo_args(*args, **kwargs)
-            hash(key)
-        except TypeError as e:
-            if len(e.args) == 1 \
-                   and isinstance(e.args[0], basestring) \
-                   and e.args[0].startswith("unhashable type:"):
-                hashable = False
-            else:
-                raise
-        else:
-            hashable = True
+    cache_get = cache.get
 
-        if hashable:
-            if key in cache:
-                return cache[key]
-            else:
-                my_lock = Lock()
-                with my_lock:
-                    key_lock = pending.setdefault(key, my_lock)
-                    if key_lock is my_lock:
-                        # we get strange (wrong) behavior with
-                        # weakrefs if we hold onto key_lock/my_lock
-                        del key_lock
-                        del my_lock
-                        cache[key] = retval = f(*args, **kwargs)
-                        return retval
-                    else:
-                        with key_lock:
-                            return cache[key]
+    def unmemoized(e, args, kwargs):
+        if not _unhashable(e):
+            raise
+        warnings.warn("Unable to memoize: unhashable argument")
+        counts[2] += 1
+        return f(*args, **kwargs)
+
+    def unmemoized_miss(e, args, kwargs):
+        # already counted as a miss
+        counts[1] -= 1
+        return unmemoized(e, args, kwargs)
 
+    # decorator_decorator calls us with f's exact signature, so unless f
+    # takes **kwargs, every argument arrives positionally and we can use
+    # cheaper keys. cache.get hashes the key once and doesn't raise on a
+    # miss. It's also atomic, so a bounded cache can't evict key between
+    # a check and a fetch.
+    try:
+        argspec = getargspec(f)
+    except TypeError:
+        argspec = None
+    if argspec is not None and argspec.keywords is None:
+        if argspec.varargs is None and len(argspec.args) == 1:
+            def memoized(arg):
+                try:
+                    retval = cache_get(arg, _missing)
+                except TypeError as e:
+                    return unmemoized(e, (arg,), {})
+                if retval is _missing:
+                    counts[1] += 1
+                    if _profiling:
+                        return _timed_compute_once(counts, cache, pending,
+                                                   arg, f, (arg,), {},
+                                                   unmemoized=unmemoized_miss)
+                    return _compute_once(cache, pending, arg, f, (arg,), {},
+                                         unmemoized=unmemoized_miss)
+                counts[0] += 1
+                return retval
         else:
-            warnings.warn("Unable to memoize: unhashable argument")
-            return f(*args, **kwargs)
-    memoized.clear = cache.clear
+            def memoized(*args):
+                try:
+                    retval = cache_get(args, _missing)
+                except TypeError as e:
+                    return unmemoized(e, args, {})
+                if retval is _missing:
+                    counts[1] += 1
+                    if _profiling:
+                        return _timed_compute_once(counts, cache, pending,
+                                                   args, f, args, {},
+                                                   unmemoized=unmemoized_miss)
+                    return _compute_once(cache, pending, args, f, args, {},
+                                         unmemoized=unmemoized_miss)
+                counts[0] += 1
+                return retval
+    else:
+        def memoized(*args, **kwargs):
+            try:
+                key = format_memo_args(*args, **kwargs)
+                retval = cache_get(key, _missing)
+            except TypeError as e:
+                return unmemoized(e, args, kwargs)
+            if retval is _missing:
+                counts[1] += 1
+                if _profiling:
+                    return _timed_compute_once(counts, cache, pending,
+                                               key, f, args, kwargs,
+                                               unmemoized=unmemoized_miss)
+                return _compute_once(cache, pending, key, f, args, kwargs,
+                                     unmemoized=unmemoized_miss)
+            counts[0] += 1
+            return retval
+
+    def cache_info():
+        return CacheInfo(counts[0], counts[1], _cache_maxsize(cache),
+                         len(cache))
+    def clear():
+        cache.clear()
+        counts[:] = [0, 0, 0, 0.0, 0]
+    memoized.cache_info = cache_info
+    memoized.clear = clear
+    if _profiling:
+        _profiled[memoized] = _make_profile(f, cache, counts)
     return memoized
 
 def format_weakmemo_args(*args, **kwargs):
-    return WeakCompoundKey(*args, **kwargs)
+    return LeanWeakCompoundKey(*args, **kwargs)
 
 @decorator_decorator
 def weakmemoize(f, cache=None):
     """weakmemoize memoizes its argument.
     Argument references are weakly held to prevent memory leaks.
-    There is a substantial performance penalty to how weakmemoize holds its references.
-    If you are concerned about this, use the higher-performance memoize.
+    Holding them weakly still costs a few weakrefs per call, so if you
+    don't need that, use the higher-performance memoize.
     If the memoized function recurses with the same arguments, instead
     of overflowing the stack, it will deadlock.
     weakmemoize is intended for use as a decorator. e.g.
@@ -133,7 +405,11 @@ def weakmemoize(f, cache=None):
 
     if cache is None:
         cache = WeakKeyDictionary()
-    pending = WeakValueDictionary()
+    pending = {}
+    # holds the keys stored in cache until one of their arguments dies
+    registry = WeakKeyRegistry()
+    # hits, misses, uncached calls, seconds spent on timed misses, timed misses
+    counts = [0, 0, 0, 0.0, 0]
 
     def weakmemoized(*args, **kwargs):
         try:
@@ -150,37 +426,36 @@ def weakmemoize(f, cache=None):
             hashable = True
 
         if hashable:
-            if key in cache:
-                return cache[key]
-            else:
-                my_lock = Lock()
-                with my_lock:
-                    # It's OK that this makes a strong reference to
-                    # key. We want key to stick around at least until
-                    # we leave this scope, at which point my_lock will
-                    # be collected and the whole dict entry will be
-                    # freed, potentially taking key with it.
-                    key_lock = pending.setdefault(key, my_lock)
-                    if key_lock is my_lock:
-                        # we get strange (wrong) behavior with
-                        # weakrefs if we hold onto key_lock/my_lock
-                        del key_lock
-                        del my_lock
-                        cache[key] = retval = f(*args, **kwargs)
-                        return retval
-                    else:
-                        with key_lock:
-                            return cache[key]
+            retval = cache.get(key, _missing)
+            if retval is not _missing:
+                counts[0] += 1
+                return retval
+            counts[1] += 1
+            # pending holds a strong reference to key only while it's
+            # being computed
+            if _profiling:
+                return _timed_compute_once(counts, cache, pending, key, f,
+                                           args, kwargs, registry)
+            return _compute_once(cache, pending, key, f, args, kwargs,
+                                 registry)
 
         else:
             warnings.warn("Unable to memoize: unable to hash or weak reference argument")
+            counts[2] += 1
             return f(*args, **kwargs)
-    weakmemoized.clear = cache.clear
+    def clear():
+        cache.clear()
+        registry.clear()
+        counts[:] = [0, 0, 0, 0.0, 0]
+    weakmemoized.clear = clear
+    if _profiling:
+        _profiled[weakmemoized] = _make_profile(f, cache, counts)
     return weakmemoized
 
 memoized = memoize
 weakmemoized = weakmemoize
-__all__ = ['memoize','memoized', 'weakmemoize', 'weakmemoized']
+__all__ = ['memoize','memoized', 'weakmemoize', 'weakmemoized', 'make_cache',
+           'CacheInfo', 'MemoProfile', 'enable_profiling', 'profile', 'report']
 
 import callable_module
 callable_module(memoize)
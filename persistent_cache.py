@@ -0,0 +1,290 @@
+# This file is part of stupid_python_tricks written by Duncan Townsend.
+#
+# stupid_python_tricks is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# stupid_python_tricks is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with stupid_python_tricks.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from collections import MutableMapping
+from threading import Lock
+from tempfile import NamedTemporaryFile
+from hashlib import sha1
+import os, errno, cPickle
+
+
+class PersistentCache(MutableMapping):
+    """PersistentCache is a dictionary stored in a directory, so that its
+    entries survive restarts. It's meant to be handed to memoize, or to
+    anything that takes a memo dict, e.g.
+
+    horner_form(poly, memo=PersistentCache("/var/cache/horner"))
+
+    Each entry is a file named after the sha1 of the pickled key, in a
+    subdirectory named after the first two hex digits of the hash, so that
+    no directory gets too big. Entries are written to a temporary file and
+    renamed into place, so readers (including other processes) never see a
+    partial entry. The pickled key is stored alongside the value and
+    compared on lookup, so a hash collision is a miss, not a wrong answer.
+    Keys that are equal but pickle differently (e.g. dicts built in a
+    different order) are different keys as far as the cache is concerned.
+    A key that can't be pickled is never found, and an entry whose key or
+    value can't be pickled is silently not stored (and counted in
+    unpicklable).
+
+    If max_bytes is given, storing an entry that takes the total size of
+    the directory over max_bytes deletes entries, least recently used
+    (by mtime; hits touch their entry) first, until the total is under
+    max_bytes * low_water. Evicting below the limit means we don't rescan
+    the directory on every store once the cache is full."""
+    __slots__ = ["directory", "max_bytes", "low_water", "size",
+                 "unpicklable", "lock"]
+
+    def __init__(self, directory, max_bytes=None, low_water=0.9):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        self.unpicklable = 0
+        self.lock = Lock()
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self.size = sum(size for _, size, _ in self._entries())
+
+    def _path(self, key):
+        """Return (pickled, path), or None if key can't be pickled."""
+        try:
+            pickled = cPickle.dumps(key, cPickle.HIGHEST_PROTOCOL)
+        except (cPickle.PicklingError, TypeError):
+            return None
+        digest = sha1(pickled).hexdigest()
+        return pickled, os.path.join(self.directory, digest[:2], digest[2:])
+
+    def _entries(self):
+        """Yield (path, size, mtime) for each entry. Entries that vanish
+        while we look (e.g. another process evicted them) are skipped."""
+        directory = self.directory
+        for shard in os.listdir(directory):
+            if len(shard) != 2:
+                continue
+            shard = os.path.join(directory, shard)
+            try:
+                names = os.listdir(shard)
+            except OSError as e:
+                if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                    continue
+                raise
+            for name in names:
+                path = os.path.join(shard, name)
+                try:
+                    st = os.stat(path)
+                except OSError as e:
+                    if e.errno == errno.ENOENT:
+                        continue
+                    raise
+                yield path, st.st_size, st.st_mtime
+
+    def _read(self, path):
+        """Return the (pickled key, value) entry at path, or None if there
+        isn't one. An entry that can't be unpickled (e.g. one a crash left
+        empty) is removed and treated as missing."""
+        try:
+            with open(path, "rb") as f:
+                return cPickle.load(f)
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        except (cPickle.UnpicklingError, EOFError, ValueError):
+            pass
+        with self.lock:
+            try:
+                size = os.stat(path).st_size
+                os.remove(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            else:
+                self.size -= size
+        return None
+
+    def __getitem__(self, key):
+        dumped = self._path(key)
+        if dumped is None:
+            raise KeyError(key)
+        pickled, path = dumped
+        entry = self._read(path)
+        if entry is None or entry[0] != pickled:
+            raise KeyError(key)
+        try:
+            os.utime(path, None)
+        except OSError as e:
+            # evicted since we read it; we still have the value
+            if e.errno != errno.ENOENT:
+                raise
+        return entry[1]
+
+    def __contains__(self, key):
+        dumped = self._path(key)
+        if dumped is None:
+            return False
+        pickled, path = dumped
+        entry = self._read(path)
+        return entry is not None and entry[0] == pickled
+
+    def __setitem__(self, key, value):
+        dumped = self._path(key)
+        if dumped is None:
+            self.unpicklable += 1
+            return
+        pickled, path = dumped
+        shard = os.path.dirname(path)
+        try:
+            os.mkdir(shard)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        f = NamedTemporaryFile(dir=self.directory, suffix=".tmp",
+                               delete=False)
+        try:
+            with f:
+                try:
+                    cPickle.dump((pickled, value), f,
+                                 cPickle.HIGHEST_PROTOCOL)
+                except (cPickle.PicklingError, TypeError):
+                    new_size = None
+                else:
+                    new_size = f.tell()
+            if new_size is None:
+                os.remove(f.name)
+                self.unpicklable += 1
+                return
+            with self.lock:
+                try:
+                    old_size = os.stat(path).st_size
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    old_size = 0
+                os.rename(f.name, path)
+                self.size += new_size - old_size
+        except:
+            try:
+                os.remove(f.name)
+            except OSError:
+                pass
+            raise
+        if self.max_bytes is not None and self.size > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        with self.lock:
+            # other processes may have added or evicted entries, so
+            # rescan rather than trusting self.size
+            entries = sorted(self._entries(), key=lambda entry: entry[2])
+            size = sum(entry[1] for entry in entries)
+            target = self.max_bytes * self.low_water
+            for path, entry_size, _ in entries:
+                if size <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                size -= entry_size
+            self.size = size
+
+    def __delitem__(self, key):
+        dumped = self._path(key)
+        if dumped is None:
+            raise KeyError(key)
+        pickled, path = dumped
+        entry = self._read(path)
+        if entry is None or entry[0] != pickled:
+            raise KeyError(key)
+        with self.lock:
+            try:
+                size = os.stat(path).st_size
+                os.remove(path)
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    raise KeyError(key)
+                raise
+            self.size -= size
+
+    def __iter__(self):
+        for path, _, _ in self._entries():
+            entry = self._read(path)
+            if entry is not None:
+                yield cPickle.loads(entry[0])
+
+    def __len__(self):
+        return sum(1 for _ in self._entries())
+
+    def clear(self):
+        with self.lock:
+            for path, _, _ in self._entries():
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+            self.size = 0
+
+    def __repr__(self):
+        return "%s(%r, max_bytes=%r)" % (type(self).__name__,
+                                         self.directory, self.max_bytes)
+
+
+if __name__ == "__main__":
+    from tempfile import mkdtemp
+    from time import time, sleep
+    from memoize import memoize
+    import shutil, warnings
+
+    directory = mkdtemp()
+    try:
+        for attempt in xrange(2):
+            # a fresh PersistentCache each time, as if we had restarted
+            @memoize(PersistentCache(directory, max_bytes=1 << 20))
+            def slow_square(x):
+                sleep(0.001)
+                return x * x
+            start = time()
+            for i in xrange(500):
+                slow_square(i)
+            print "run %d: %.3fs" % (attempt, time() - start)
+
+        # unhashable arguments pickle fine, but must still be passed
+        # through uncached rather than blowing up memoize
+        @memoize(PersistentCache(directory))
+        def total(xs):
+            return sum(xs)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            if total([1, 2, 3]) != 6:
+                raise RuntimeError("memoize(PersistentCache) is broken for "
+                                   "unhashable arguments")
+
+        # a truncated entry is a miss, not an error
+        cache = PersistentCache(directory)
+        cache["truncated"] = 1
+        open(cache._path("truncated")[1], "wb").close()
+        if "truncated" in cache or cache.get("truncated") is not None:
+            raise RuntimeError("PersistentCache returned a truncated entry")
+    finally:
+        shutil.rmtree(directory)
+
+
+__all__ = ["PersistentCache"]
@@ -15,7 +15,12 @@
 
 from itertools import *
 from fractions import gcd
-from operator import itemgetter
+from operator import itemgetter, index
+from array import array
+from collections import deque
+from ctypes import memmove, string_at
+from random import randrange
+from math import log
 
 
 def simple():
@@ -238,6 +243,407 @@ def variable_wheel():
 
 
 
+def _isqrt(n):
+    """The largest integer whose square is at most n, exactly, even for
+    numbers too big for a float."""
+    if n < 0:
+        raise ValueError("square root of negative number")
+    if n == 0:
+        return 0
+    x = 1 << ((n.bit_length() + 1) >> 1)
+    while True:
+        y = (x + n // x) >> 1
+        if y >= x:
+            return x
+        x = y
+
+
+def _sieve_bytearray(n):
+    """Return a bytearray whose ith element is 1 if i is prime and 0 if it
+    isn't, for i < n. This is the plain Sieve of Eratosthenes, but the
+    inner loop is a single extended slice assignment, so it runs in C."""
+    if n < 2:
+        return bytearray(max(n, 0))
+    sieve = bytearray([1]) * n
+    sieve[:2] = bytearray(2)
+    for p in xrange(2, _isqrt(n - 1) + 1):
+        if sieve[p]:
+            sieve[p*p::p] = bytearray((n - 1 - p*p) // p + 1)
+    return sieve
+
+
+def _wheel_template(wheel, segment_size):
+    """Return (wheel_primes, modulus, template) where wheel_primes are the
+    first wheel primes and modulus is their product. Sieve segments only
+    represent odd numbers: the ith element of a segment starting at seg_lo
+    stands for seg_lo + 2*i + 1. template is a bytearray of 1s for the odd
+    numbers coprime to modulus, repeated to cover about segment_size
+    numbers. A segment that starts at a multiple of modulus starts out as a
+    copy of template, so the wheel primes never have to be crossed off."""
+    if wheel < 1:
+        raise ValueError("The wheel must at least include 2")
+    w = nth(wheel, Wheel)
+    modulus = w.modulus
+    pattern = bytearray(modulus // 2)
+    for spoke in xrange(len(w.spokes)):
+        pattern[(w.spokes[spoke] % modulus) // 2] = 1
+    return (list(take(wheel, simple())), modulus,
+            pattern * max(1, segment_size // modulus))
+
+
+def _base_primes(limit, wheel_primes):
+    """The primes up to and including limit that aren't wheel primes."""
+    return [p for p in compress(xrange(limit + 1), _sieve_bytearray(limit + 1))
+            if p not in wheel_primes]
+
+
+def _sieve_segment(seg, seg_lo, base_primes):
+    """Cross off the multiples of base_primes in seg, a bytearray
+    representing the odd numbers from seg_lo up (see _wheel_template).
+    seg must start out as a copy of a wheel template with seg_lo a multiple
+    of the wheel's modulus, and base_primes must include every prime up to
+    the square root of the end of the segment that isn't a wheel prime."""
+    length = len(seg)
+    seg_hi = seg_lo + 2 * length
+    for p in base_primes:
+        start = p * p
+        if start >= seg_hi:
+            break
+        if start < seg_lo:
+            # the first odd multiple of p in the segment
+            start = -(-seg_lo // p) | 1
+            start *= p
+        # consecutive odd multiples of p are p elements apart
+        first = (start - seg_lo) >> 1
+        seg[first::p] = bytearray((length - 1 - first) // p + 1)
+    if seg_lo == 0:
+        # 1 is coprime to everything
+        seg[0] = 0
+    return seg
+
+
+def segmented_sieve(lo=2, hi=None, wheel=4, segment_size=1 << 20):
+    """Generate the primes p with lo <= p < hi (or without bound if hi is
+    None), in order.
+
+    This is a segmented Sieve of Eratosthenes: it sieves segment_size
+    numbers at a time in a bytearray, so its memory use doesn't grow with
+    hi. Each segment starts out as a copy of the pattern of a Wheel (the
+    wheel'th one, so by default the one with modulus 2*3*5*7), which crosses
+    off the multiples of the wheel primes for free. Segments only store odd
+    numbers, so the default segment size takes half a megabyte, which fits
+    in most L2 caches."""
+    lo = max(lo, 0)
+    wheel_primes, modulus, template = _wheel_template(wheel, segment_size)
+    small = [p for p in wheel_primes if lo <= p and (hi is None or p < hi)]
+
+    def segments():
+        seg_lo = lo - lo % modulus
+        span = 2 * len(template)
+        limit = 0
+        base_primes = []
+        while hi is None or seg_lo < hi:
+            seg_hi = seg_lo + span
+            needed = _isqrt(seg_hi - 1)
+            if needed > limit:
+                # grow geometrically, so an unbounded sieve doesn't resieve
+                # its base primes for every segment
+                limit = max(needed, 2 * limit)
+                base_primes = _base_primes(limit, wheel_primes)
+            seg = _sieve_segment(bytearray(template), seg_lo, base_primes)
+            first = max(lo - seg_lo, 0) >> 1
+            last = (span if hi is None else min(hi - seg_lo, span)) >> 1
+            yield compress(xrange(seg_lo + 2 * first + 1, seg_lo + 2 * last, 2),
+                           seg[first:last])
+            seg_lo = seg_hi
+
+    return chain(small, chain.from_iterable(segments()))
+
+
+def primes_between(lo, hi, wheel=4):
+    """Return a list of the primes p with lo <= p < hi."""
+    return list(segmented_sieve(lo, hi, wheel))
+
+
+def sieve_array(n, wheel=4, segment_size=1 << 21):
+    """Return all the primes below n, in bulk. With numpy, they come back
+    as a uint32 array (uint64 if n is too big for that). They're computed
+    like segmented_sieve does, except that segments are boolean masks of
+    the odd numbers and both crossing off and collecting the primes are
+    vectorized. Without numpy, they come back as an array.array('L') filled
+    from segmented_sieve."""
+    try:
+        import numpy
+    except ImportError:
+        return array('L', segmented_sieve(2, n, wheel, segment_size))
+    dtype = numpy.uint32 if n <= 1 << 32 else numpy.uint64
+    wheel_primes, modulus, template = _wheel_template(wheel, segment_size)
+    template = numpy.frombuffer(template, dtype=bool)
+    span = 2 * len(template)
+    base_primes = numpy.array(_base_primes(_isqrt(max(n - 1, 0)),
+                                           wheel_primes), numpy.int64)
+    chunks = [numpy.array([p for p in wheel_primes if p < n], dtype)]
+    for seg_lo in xrange(0, n, span):
+        seg = template.copy()
+        seg_hi = seg_lo + span
+        ps = base_primes[:numpy.searchsorted(base_primes, _isqrt(seg_hi - 1),
+                                             "right")]
+        # the first odd multiple of each prime that's in the segment and
+        # at least its square
+        starts = numpy.maximum(ps * ps, ((-(-seg_lo // ps)) | 1) * ps)
+        for first, p in izip(((starts - seg_lo) >> 1).tolist(), ps.tolist()):
+            seg[first::p] = False
+        if seg_lo == 0:
+            # 1 is coprime to everything
+            seg[0] = False
+        odd = numpy.flatnonzero(seg[:min(n - seg_lo, span) >> 1])
+        chunks.append((2 * odd + (seg_lo + 1)).astype(dtype))
+    return numpy.concatenate(chunks)
+
+
+# The state of a parallel_primes worker process: (base_primes, slots,
+# template, lo, hi). It's set up once per process by _parallel_init.
+_parallel_state = None
+
+def _parallel_init(base_primes, slots, wheel, segment_size, lo, hi):
+    global _parallel_state
+    _, _, template = _wheel_template(wheel, segment_size)
+    _parallel_state = (list(base_primes), slots, template, lo, hi)
+
+def _parallel_segment(slot, seg_lo):
+    """Sieve the segment starting at seg_lo and write the primes in it to
+    shared slot number slot. Returns (slot, number of primes)."""
+    base_primes, slots, template, lo, hi = _parallel_state
+    seg = _sieve_segment(bytearray(template), seg_lo, base_primes)
+    span = 2 * len(seg)
+    first = max(lo - seg_lo, 0) >> 1
+    last = min(hi - seg_lo, span) >> 1
+    found = array('l', compress(xrange(seg_lo + 2 * first + 1,
+                                       seg_lo + 2 * last, 2),
+                                seg[first:last]))
+    address, count = found.buffer_info()
+    memmove(slots[slot], address, count * found.itemsize)
+    return slot, count
+
+def parallel_primes(lo, hi, workers=None, wheel=4, segment_size=None):
+    """Generate the primes p with lo <= p < hi, in order, sieving in
+    parallel in a pool of workers processes (by default, one per CPU).
+
+    This splits [lo, hi) into segments like segmented_sieve does. The base
+    primes up to the square root of hi are computed once and shared with
+    the workers through shared memory. Each worker sieves its segment
+    (starting from the Wheel template, like segmented_sieve) and writes
+    the primes it finds to a shared buffer, so the results never get
+    pickled. There are twice as many buffers as workers; the segments are
+    handed out and read back in order, so the workers run ahead of the
+    consumer by at most that many segments.
+
+    By default, segments are at least as long as the square root of hi,
+    so that every base prime has something to cross off in each one."""
+    from multiprocessing import Pool, cpu_count
+    from multiprocessing.sharedctypes import RawArray
+
+    lo = max(lo, 0)
+    if workers is None:
+        workers = cpu_count()
+    if segment_size is None:
+        segment_size = max(1 << 21, _isqrt(max(hi, 0)))
+    wheel_primes, modulus, template = _wheel_template(wheel, segment_size)
+    small = [p for p in wheel_primes if lo <= p < hi]
+
+    def segments():
+        if lo >= hi:
+            return
+        span = 2 * len(template)
+        base_primes = RawArray('l', _base_primes(_isqrt(hi - 1), wheel_primes))
+        # a segment can't hold more primes than the template has candidates
+        capacity = template.count('\x01') + 1
+        slots = [RawArray('l', capacity) for _ in xrange(2 * workers)]
+        pool = Pool(workers, _parallel_init,
+                    (base_primes, slots, wheel, segment_size, lo, hi))
+        try:
+            seg_los = iter(xrange(lo - lo % modulus, hi, span))
+            running = deque()
+            for slot, seg_lo in izip(xrange(len(slots)), seg_los):
+                running.append(pool.apply_async(_parallel_segment,
+                                                (slot, seg_lo)))
+            while running:
+                slot, count = running.popleft().get()
+                found = array('l')
+                found.fromstring(string_at(slots[slot],
+                                           count * found.itemsize))
+                for seg_lo in islice(seg_los, 1):
+                    running.append(pool.apply_async(_parallel_segment,
+                                                    (slot, seg_lo)))
+                yield found
+        finally:
+            pool.terminate()
+            pool.join()
+
+    return chain(small, chain.from_iterable(segments()))
+
+
+_trial_primes = tuple(primes_between(2, 256))
+# Miller-Rabin with the primes up to 41 as bases is deterministic below this,
+# the smallest strong pseudoprime to all of them (Sorenson and Webster, 2015)
+_deterministic_limit = 3317044064679887385961981
+_deterministic_bases = _trial_primes[:13]
+
+def _miller_rabin(n, bases):
+    """Return False if any of bases proves that n (odd, > 2) is composite,
+    and True otherwise."""
+    d = n - 1
+    s = 0
+    while not d & 1:
+        d >>= 1
+        s += 1
+    for a in bases:
+        x = pow(a, d, n)
+        if x == 1 or x == n - 1:
+            continue
+        for _ in xrange(s - 1):
+            x = x * x % n
+            if x == n - 1:
+                break
+        else:
+            return False
+    return True
+
+def is_prime(n, rounds=32):
+    """Return whether n is prime, without generating the primes below it.
+
+    This does trial division by the primes below 256, followed by
+    Miller-Rabin. Below 3.3*10**24 (which includes every 64-bit n), the
+    Miller-Rabin bases are the primes up to 41, which makes the answer
+    exact. Above that, it uses rounds random bases, so a composite n is
+    reported as prime with probability at most 4**-rounds."""
+    n = index(n)
+    if n < 2:
+        return False
+    for p in _trial_primes:
+        if n % p == 0:
+            return n == p
+    if n < _trial_primes[-1] ** 2:
+        return True
+    if n < _deterministic_limit:
+        return _miller_rabin(n, _deterministic_bases)
+    return _miller_rabin(n, (randrange(2, n - 1) for _ in xrange(rounds)))
+
+def is_prime_many(iterable, rounds=32):
+    """Return a list of whether each element of iterable is prime. When the
+    numbers are small compared to how many there are, this sieves up to the
+    largest of them instead of testing them one by one."""
+    values = map(index, iterable)
+    if not values:
+        return []
+    largest = max(values)
+    if largest < min(1 << 26, max(1 << 16, 4096 * len(values))):
+        sieve = _sieve_bytearray(largest + 1)
+        return [n >= 0 and bool(sieve[n]) for n in values]
+    return [is_prime(n, rounds) for n in values]
+
+
+def _prime_pi_python(x):
+    """Lucy_Hedgehog's algorithm in pure python. Let S(v, p) count the
+    numbers in [2, v] that are prime or have no prime factor up to p. Then
+    S(v, p) = S(v, p-1) - (S(v//p, p-1) - S(p-1, p-1)) for prime p, and
+    pi(x) = S(x, isqrt(x)). Only the values v = x//i are ever needed, so
+    small[v] holds S(v) for v <= isqrt(x) and large[i] holds S(x//i)."""
+    r = _isqrt(x)
+    small = [max(v - 1, 0) for v in xrange(r + 1)]
+    large = [0] + [x // i - 1 for i in xrange(1, r + 1)]
+    for p in primes_between(2, r + 1):
+        sp = small[p - 1]
+        p2 = p * p
+        # large[i] (and small[v]) depend on smaller values, which we update
+        # later, so these loops see S(., p-1) on the right hand side
+        for i in xrange(1, min(r, x // p2) + 1):
+            ip = i * p
+            if ip <= r:
+                large[i] -= large[ip] - sp
+            else:
+                large[i] -= small[x // ip] - sp
+        for v in xrange(r, p2 - 1, -1):
+            small[v] -= small[v // p] - sp
+    return large[1]
+
+def _prime_pi_numpy(x, numpy):
+    """_prime_pi_python, with each of its inner loops done as a single
+    vectorized update. The right hand sides are computed before anything is
+    assigned, so they see S(., p-1) just like the loops do."""
+    r = _isqrt(x)
+    small = numpy.arange(-1, r, dtype=numpy.int64)
+    small[0] = 0
+    large = numpy.zeros(r + 1, dtype=numpy.int64)
+    large[1:] = x // numpy.arange(1, r + 1, dtype=numpy.int64) - 1
+    for p in primes_between(2, r + 1):
+        sp = small[p - 1]
+        p2 = p * p
+        end = min(r, x // p2)
+        # up to split, x//(i*p) is one of the large values
+        split = min(end, r // p)
+        large[1:split + 1] -= large[p:split * p + 1:p] - sp
+        if end > split:
+            i = numpy.arange(split + 1, end + 1, dtype=numpy.int64)
+            large[split + 1:end + 1] -= small[x // (i * p)] - sp
+        if p2 <= r:
+            # v//p for v = p2, p2+1, ... r is p, ..., p (p times), p+1, ...
+            small[p2:] -= numpy.repeat(small[p:r // p + 1], p)[:r - p2 + 1] - sp
+    return int(large[1])
+
+def prime_pi(x):
+    """Return the number of primes <= x, in about x**(3/4) operations,
+    using Lucy_Hedgehog's algorithm. With numpy, its inner loops are
+    vectorized; without it, they run in pure python."""
+    x = index(x)
+    if x < 2:
+        return 0
+    if x < 1 << 62:
+        try:
+            import numpy
+        except ImportError:
+            pass
+        else:
+            return _prime_pi_numpy(x, numpy)
+    return _prime_pi_python(x)
+
+def nth_prime(n):
+    """Return the nth prime, counting from 0 like nth(n, variable_wheel())
+    does, so nth_prime(0) == 2.
+
+    This guesses where the prime is with the asymptotic expansion of p_n,
+    corrects the guess with a Newton step on pi, and then sieves the short
+    window between the guess and the prime."""
+    n = index(n)
+    if n < 0:
+        raise IndexError("There is no prime with a negative index")
+    k = n + 1
+    if k < 6:
+        return (2, 3, 5, 7, 11)[n]
+    log_k = log(k)
+    log_log_k = log(log_k)
+    # p_k ~ k (log k + log log k - 1 + (log log k - 2) / log k)
+    x = int(k * (log_k + log_log_k - 1 + (log_log_k - 2) / log_k))
+    count = prime_pi(x)
+    step = int((k - count) * log(x))
+    if abs(step) > 1 << 16:
+        x += step
+        count = prime_pi(x)
+    if count < k:
+        # the prime is the (k - count)th one after x
+        return nth(k - count - 1, segmented_sieve(x + 1))
+    # the prime is the (count - k)th one before x (counting x itself as
+    # the 0th, if it's prime); sieve windows going down until we find it
+    width = max(int(log(x)) * (count - k + 1) * 2, 1 << 10)
+    hi = x + 1
+    while True:
+        found = primes_between(max(hi - width, 0), hi)
+        if len(found) > count - k:
+            return found[len(found) - 1 - (count - k)]
+        count -= len(found)
+        hi -= width
+
+
 def _check_fixed(index, up_to):
     try:
         import pyprimes.sieves
@@ -265,4 +671,4 @@ def _check_variable(up_to):
 
 if __name__ == '__main__':
     import sys
-    print nth(int(sys.argv[1]), variable_wheel())
+    print nth_prime(int(sys.argv[1]))
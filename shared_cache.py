@@ -0,0 +1,346 @@
+# This file is part of stupid_python_tricks written by Duncan Townsend.
+#
+# stupid_python_tricks is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# stupid_python_tricks is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with stupid_python_tricks.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from collections import MutableMapping
+from threading import Lock
+from mmap import mmap
+from fcntl import flock, LOCK_SH, LOCK_EX, LOCK_UN
+from struct import Struct
+from zlib import crc32
+from time import time
+import os, cPickle
+
+
+class SharedCache(MutableMapping):
+    """SharedCache is a dictionary stored in a mmap'd file, so that every
+    process on a host that opens the same path sees the same entries. It's
+    meant to be handed to memoize, e.g.
+
+    @memoize(SharedCache("/tmp/foo.cache"))
+    def foo(*args, **kwargs):
+        ...
+
+    Keys and values are pickled, so they must be picklable, and keys must
+    pickle to the same string in every process (e.g. ints, strings and
+    tuples of them; no objects that hash by id). Lookups compare the pickled
+    keys, not the unpickled ones.
+
+    The file is a fixed-size, set-associative hash table: a key may only
+    live in one of the ways slots of the bucket picked by the crc32 of its
+    pickle. When that bucket is full, storing a key evicts the entry that
+    was written longest ago. An entry whose pickled key and value don't fit
+    in slot_size bytes is silently not stored (and counted in oversized),
+    because a cache that refuses to cache is still a correct cache. For the
+    same reason, a key or value that can't be pickled is never found and
+    never stored (and counted in unpicklable).
+
+    Readers take a shared flock on the file and writers take an exclusive
+    one. The geometry is fixed when the file is created; later opens use
+    whatever is in the file and ignore the arguments."""
+    __slots__ = ["path", "buckets", "ways", "slot_size", "maxsize",
+                 "oversized", "unpicklable", "lock", "fd", "pid", "map"]
+
+    _header = Struct("<8sIII")      # magic, buckets, ways, slot_size
+    _count = Struct("<Q")           # number of used slots
+    _slot = Struct("<?xxxIId")      # used, crc, key length, write time
+    _magic = "SPTSHC01"
+    _data_start = _header.size + _count.size
+
+    def __init__(self, path, buckets=4096, ways=8, slot_size=256):
+        self.path = path
+        self.oversized = 0
+        self.unpicklable = 0
+        self.lock = Lock()
+        self.fd = None
+        self.pid = None
+        self.map = None
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0666)
+        try:
+            flock(fd, LOCK_EX)
+            try:
+                if os.fstat(fd).st_size == 0:
+                    if slot_size <= self._slot.size:
+                        raise ValueError("slot_size is too small")
+                    size = self._data_start + buckets * ways * slot_size
+                    os.ftruncate(fd, size)
+                    os.write(fd, self._header.pack(self._magic, buckets,
+                                                   ways, slot_size))
+                else:
+                    header = os.read(fd, self._header.size)
+                    if len(header) != self._header.size:
+                        raise ValueError("%r is not a SharedCache" % (path,))
+                    magic, buckets, ways, slot_size = \
+                        self._header.unpack(header)
+                    if magic != self._magic:
+                        raise ValueError("%r is not a SharedCache" % (path,))
+                    size = self._data_start + buckets * ways * slot_size
+                self.map = mmap(fd, size)
+            finally:
+                flock(fd, LOCK_UN)
+        except:
+            os.close(fd)
+            raise
+        self.buckets = buckets
+        self.ways = ways
+        self.slot_size = slot_size
+        self.maxsize = buckets * ways
+        self.fd = fd
+        self.pid = os.getpid()
+
+    def close(self):
+        with self.lock:
+            if self.map is not None:
+                self.map.close()
+                self.map = None
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def _locked(self, mode):
+        """Take the file lock; the caller must hold self.lock and release
+        the file lock with _unlock."""
+        if self.map is None:
+            raise ValueError("I/O operation on closed SharedCache")
+        if self.pid != os.getpid():
+            # A forked child shares our open file description, and with it
+            # our flock. Reopen the file so that we exclude each other.
+            os.close(self.fd)
+            self.fd = os.open(self.path, os.O_RDWR)
+            self.pid = os.getpid()
+        flock(self.fd, mode)
+
+    def _unlock(self):
+        flock(self.fd, LOCK_UN)
+
+    def _dump_key(self, key):
+        """Return (pickled, crc, first), or None if key can't be pickled."""
+        try:
+            pickled = cPickle.dumps(key, cPickle.HIGHEST_PROTOCOL)
+        except (cPickle.PicklingError, TypeError):
+            return None
+        crc = crc32(pickled) & 0xffffffff
+        first = self._data_start \
+                + (crc % self.buckets) * self.ways * self.slot_size
+        return pickled, crc, first
+
+    def _find(self, pickled, crc, first):
+        """Return the offset of the slot holding pickled, or None."""
+        m = self.map
+        unpack_from = self._slot.unpack_from
+        slot_size = self.slot_size
+        header_size = self._slot.size
+        keylen = len(pickled)
+        for offset in xrange(first, first + self.ways * slot_size, slot_size):
+            used, slot_crc, slot_keylen, _ = unpack_from(m, offset)
+            if used and slot_crc == crc and slot_keylen == keylen:
+                start = offset + header_size
+                if m[start:start + keylen] == pickled:
+                    return offset
+        return None
+
+    def _read_value(self, offset, keylen):
+        m = self.map
+        start = offset + self._slot.size + keylen
+        return cPickle.loads(m[start:offset + self.slot_size])
+
+    def _add_count(self, delta):
+        m = self.map
+        start = self._header.size
+        count, = self._count.unpack_from(m, start)
+        self._count.pack_into(m, start, count + delta)
+
+    def __getitem__(self, key):
+        dumped = self._dump_key(key)
+        if dumped is None:
+            raise KeyError(key)
+        pickled, crc, first = dumped
+        with self.lock:
+            self._locked(LOCK_SH)
+            try:
+                offset = self._find(pickled, crc, first)
+                if offset is None:
+                    raise KeyError(key)
+                return self._read_value(offset, len(pickled))
+            finally:
+                self._unlock()
+
+    def __contains__(self, key):
+        dumped = self._dump_key(key)
+        if dumped is None:
+            return False
+        pickled, crc, first = dumped
+        with self.lock:
+            self._locked(LOCK_SH)
+            try:
+                return self._find(pickled, crc, first) is not None
+            finally:
+                self._unlock()
+
+    def __setitem__(self, key, value):
+        dumped = self._dump_key(key)
+        if dumped is not None:
+            try:
+                pickled_value = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+            except (cPickle.PicklingError, TypeError):
+                dumped = None
+        if dumped is None:
+            self.unpicklable += 1
+            return
+        pickled, crc, first = dumped
+        data = pickled + pickled_value
+        header_size = self._slot.size
+        slot_size = self.slot_size
+        if header_size + len(data) > slot_size:
+            self.oversized += 1
+            return
+        with self.lock:
+            self._locked(LOCK_EX)
+            try:
+                m = self.map
+                offset = self._find(pickled, crc, first)
+                if offset is None:
+                    # take an empty slot, or else the oldest one
+                    oldest = None
+                    unpack_from = self._slot.unpack_from
+                    for candidate in xrange(first,
+                                            first + self.ways * slot_size,
+                                            slot_size):
+                        used, _, _, stamp = unpack_from(m, candidate)
+                        if not used:
+                            offset = candidate
+                            self._add_count(1)
+                            break
+                        if oldest is None or stamp < oldest:
+                            oldest = stamp
+                            offset = candidate
+                # the slot is marked unused while we write it, so that a
+                # process that dies mid-write never publishes a torn entry
+                self._slot.pack_into(m, offset, False, 0, 0, 0.0)
+                start = offset + header_size
+                m[start:start + len(data)] = data
+                self._slot.pack_into(m, offset, True, crc, len(pickled),
+                                     time())
+            finally:
+                self._unlock()
+
+    def __delitem__(self, key):
+        dumped = self._dump_key(key)
+        if dumped is None:
+            raise KeyError(key)
+        pickled, crc, first = dumped
+        with self.lock:
+            self._locked(LOCK_EX)
+            try:
+                offset = self._find(pickled, crc, first)
+                if offset is None:
+                    raise KeyError(key)
+                self._slot.pack_into(self.map, offset, False, 0, 0, 0.0)
+                self._add_count(-1)
+            finally:
+                self._unlock()
+
+    def __len__(self):
+        with self.lock:
+            self._locked(LOCK_SH)
+            try:
+                count, = self._count.unpack_from(self.map, self._header.size)
+                return count
+            finally:
+                self._unlock()
+
+    def __iter__(self):
+        # Snapshot the keys, so that we don't hold the file lock while the
+        # caller does who knows what.
+        keys = []
+        header_size = self._slot.size
+        unpack_from = self._slot.unpack_from
+        with self.lock:
+            self._locked(LOCK_SH)
+            try:
+                m = self.map
+                for offset in xrange(self._data_start, len(m),
+                                     self.slot_size):
+                    used, _, keylen, _ = unpack_from(m, offset)
+                    if used:
+                        start = offset + header_size
+                        keys.append(m[start:start + keylen])
+            finally:
+                self._unlock()
+        return (cPickle.loads(pickled) for pickled in keys)
+
+    def clear(self):
+        empty = self._slot.pack(False, 0, 0, 0.0)
+        header_size = self._slot.size
+        with self.lock:
+            self._locked(LOCK_EX)
+            try:
+                m = self.map
+                for offset in xrange(self._data_start, len(m),
+                                     self.slot_size):
+                    m[offset:offset + header_size] = empty
+                self._count.pack_into(m, self._header.size, 0)
+            finally:
+                self._unlock()
+
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, self.path)
+
+
+def _demo_square(x):
+    from time import sleep
+    sleep(0.01)
+    return x * x
+
+if __name__ == "__main__":
+    from multiprocessing import Pool
+    from tempfile import mkdtemp
+    from memoize import memoize
+    import shutil, warnings
+
+    directory = mkdtemp()
+    try:
+        path = os.path.join(directory, "demo.cache")
+        _demo_square = memoize(SharedCache(path))(_demo_square)
+        pool = Pool(4)
+        for attempt in xrange(2):
+            start = time()
+            pool.map(_demo_square, xrange(400))
+            print "pass %d: %.3fs" % (attempt, time() - start)
+        pool.close()
+        pool.join()
+        print "%d entries shared" % len(SharedCache(path))
+
+        # unhashable arguments pickle fine, but must still be passed
+        # through uncached rather than blowing up memoize
+        @memoize(SharedCache(path))
+        def total(xs):
+            return sum(xs)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            if total([1, 2, 3]) != 6:
+                raise RuntimeError("memoize(SharedCache) is broken for "
+                                   "unhashable arguments")
+    finally:
+        shutil.rmtree(directory)
+
+
+__all__ = ["SharedCache"]
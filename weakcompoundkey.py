@@ -19,7 +19,7 @@
 # WeakCompoundKeyStrict AS KEYS IN A weakref.WeakKeyDictionary
 
 from weakref import ref
-from itertools import imap, chain, ifilter, product
+from itertools import imap, izip, chain, ifilter, product
 from operator import itemgetter
 
 strong_refs = set()
@@ -196,4 +196,89 @@ class WeakCompoundKey(object):
         # old refs get GC'd and can no longer cause us to explode
         return True
 
-__all__ = ["WeakCompoundKeyStrict", "WeakCompoundKey"]
+
+class WeakKeyRegistry(dict):
+    """A WeakKeyRegistry holds the strong references that keep registered
+    LeanWeakCompoundKeys alive, keyed by id. Use one per cache, so that
+    caches don't contend on (or leak into) a module-global set."""
+    __slots__ = ["__weakref__"]
+
+
+class LeanWeakCompoundKey(object):
+    """LeanWeakCompoundKey is a cheaper WeakCompoundKeyStrict. It compares
+    equal to another LeanWeakCompoundKey instantiated with equal arguments
+    (while they're all alive) and is meant to be used as a key to a
+    WeakKeyDictionary.
+
+    Instantiating a LeanWeakCompoundKey only makes plain weakrefs to its
+    arguments (which CPython shares with any other plain weakrefs to them)
+    and computes its hash once, so it's cheap enough to build one on every
+    lookup. Nothing keeps it alive until it's registered: when you store it
+    in a WeakKeyDictionary, first call register with the WeakKeyRegistry
+    that belongs to that dictionary. From then on, the registry holds the
+    key until one of its arguments dies, at which point the key dies and
+    the dictionary drops its entry.
+
+    Example usage:
+    registry = WeakKeyRegistry()
+    cache = WeakKeyDictionary()
+    key = LeanWeakCompoundKey(a, b)
+    if key not in cache:
+        key.register(registry)
+        cache[key] = compute(a, b)
+    """
+    __slots__ = ["__weakref__", "__hash", "__names", "__refs", "__callbacks"]
+
+    def __init__(self, *args, **kwargs):
+        if kwargs:
+            names = tuple(sorted(kwargs))
+            values = args + tuple(imap(kwargs.__getitem__, names))
+        else:
+            names = ()
+            values = args
+        self.__hash = hash(values) ^ hash(names)
+        self.__names = names
+        self.__refs = tuple(imap(ref, values))
+        self.__callbacks = None
+
+    def register(self, registry):
+        """Keep this key alive in registry until one of its arguments dies.
+        Returns False if one of them is already dead."""
+        values = tuple(imap(lambda r: r(), self.__refs))
+        if any(imap(lambda v: v is None, values)):
+            return False
+        # the callback only holds weak references to the registry, and
+        # none to us, so we don't make reference cycles
+        registry_ref = ref(registry)
+        ident = id(self)
+        def callback(_):
+            registry = registry_ref()
+            if registry is not None:
+                registry.pop(ident, None)
+        self.__callbacks = tuple(imap(lambda v: ref(v, callback), values))
+        registry[ident] = self
+        return True
+
+    def __hash__(self):
+        return self.__hash
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, LeanWeakCompoundKey) \
+               or self.__hash != other.__hash \
+               or self.__names != other.__names \
+               or len(self.__refs) != len(other.__refs):
+            return False
+        for a, b in izip(self.__refs, other.__refs):
+            a = a()
+            b = b()
+            if a is None or b is None:
+                return False
+            if a is not b and not a == b:
+                return False
+        return True
+    def __ne__(self, other):
+        return not self == other
+
+__all__ = ["WeakCompoundKeyStrict", "WeakCompoundKey", "WeakKeyRegistry",
+           "LeanWeakCompoundKey"]